@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+
 import uvicorn
 from fastapi import FastAPI
 
-from assistance import _ctx, _logging
+from assistance import _ctx, _logging, _openai, _scheduler, _telemetry
+from assistance._cache import writer as _cache_writer
+from assistance._email.handler import redrive_parked_emails
 
 from . import contact_form, email, stripe
 
@@ -23,6 +27,8 @@ _logging.main()
 
 app = FastAPI()
 
+_background_tasks: set[asyncio.Task] = set()
+
 app.include_router(stripe.router)
 app.include_router(email.router)
 app.include_router(contact_form.router)
@@ -32,9 +38,24 @@ app.include_router(contact_form.router)
 async def startup_event():
     _ctx.open_session()
 
+    # Emails parked during an OpenAI outage are handled once it is over,
+    # including any that were parked before a restart.
+    _openai.circuit.add_close_callback(redrive_parked_emails)
+
+    for coroutine in (
+        redrive_parked_emails(),
+        _scheduler.log_queue_depths(),
+        _ctx.log_pool_stats(),
+    ):
+        task = asyncio.create_task(coroutine)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await _cache_writer.flush()
+    await _telemetry.flush()
     await _ctx.close_session()
 
 
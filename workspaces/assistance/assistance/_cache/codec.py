@@ -0,0 +1,101 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import json
+import zlib
+
+# Every record written by this module starts with one of these bytes.
+# Records from before this format are pretty-printed JSON of the full
+# OpenAI response, and so always start with "{".
+COMPLETION_RECORD = b"\x01"
+EMBEDDING_RECORD = b"\x02"
+
+ZLIB_LEVEL = 6
+
+
+def encode_completion(response) -> bytes:
+    choice = response["choices"][0]
+    record = {
+        "model": response.get("model"),
+        "usage": dict(response.get("usage") or {}),
+        "content": choice["message"]["content"],
+        "finish_reason": choice.get("finish_reason"),
+    }
+
+    function_call = choice["message"].get("function_call")
+    if function_call is not None:
+        record["function_call"] = {
+            "name": function_call["name"],
+            "arguments": function_call["arguments"],
+        }
+
+    compact = json.dumps(record, separators=(",", ":")).encode()
+
+    return COMPLETION_RECORD + zlib.compress(compact, ZLIB_LEVEL)
+
+
+def encode_embedding(result) -> bytes:
+    embedding = array.array("f", result["data"][0]["embedding"])
+
+    return EMBEDDING_RECORD + embedding.tobytes()
+
+
+def encode_legacy(value: bytes) -> bytes:
+    """Re-encode a record that was stored as a full JSON response."""
+
+    response = json.loads(value)
+
+    if "choices" in response:
+        return encode_completion(response)
+
+    return encode_embedding(response)
+
+
+def decode(value: bytes):
+    """Decode a cache record into the subset of the OpenAI response shape
+    that the callers within this library read from.
+
+    Raises ValueError if the record is corrupt.
+    """
+
+    record_type = value[:1]
+
+    if record_type == COMPLETION_RECORD:
+        try:
+            record = json.loads(zlib.decompress(value[1:]))
+        except zlib.error as e:
+            raise ValueError("Corrupt completion cache record") from e
+
+        message = {"role": "assistant", "content": record["content"]}
+        if "function_call" in record:
+            message["function_call"] = record["function_call"]
+
+        return {
+            "model": record["model"],
+            "usage": record["usage"],
+            "choices": [{"message": message, "finish_reason": record["finish_reason"]}],
+        }
+
+    if record_type == EMBEDDING_RECORD:
+        if (len(value) - 1) % 4 != 0:
+            raise ValueError("Corrupt embedding cache record")
+
+        embedding = array.array("f")
+        embedding.frombytes(value[1:])
+
+        return {"data": [{"embedding": embedding.tolist()}]}
+
+    # json.JSONDecodeError is a ValueError
+    return json.loads(value)
@@ -0,0 +1,150 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import fcntl
+import hashlib
+import os
+from typing import Any, Awaitable, Callable
+
+from assistance import _deadlines
+from assistance._paths import COMPLETION_CACHE_LOCK
+
+from . import stats, writer
+
+LOCK_POLL_INITIAL_INTERVAL = 0.05
+LOCK_POLL_MAX_INTERVAL = 1.0
+
+_in_flight: dict[str, asyncio.Future] = {}
+_lock_file_descriptor: int | None = None
+
+
+async def run_once(
+    key: str,
+    create: Callable[[], Awaitable[Any]],
+    load: Callable[[], Awaitable[Any]],
+):
+    """Share a single computation of a key between all concurrent callers.
+
+    Callers within this process await the same future. Across processes
+    (the API runs many gunicorn workers) a lock on the key is held for the
+    duration of the computation, and any process that had to wait for it
+    re-reads the cache via ``load`` before computing anything itself. That
+    lock is held until the computed record has been written to the store.
+    """
+
+    try:
+        future = _in_flight[key]
+    except KeyError:
+        future = asyncio.ensure_future(_create_with_process_lock(key, create, load))
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _remove(key, future))
+    else:
+        stats.increment("coalesced")
+
+    # Shielded so that one cancelled caller does not cancel the request that
+    # the other callers are also waiting on. Each caller stops waiting at
+    # their own deadline, which may be sooner than that of the caller that
+    # started the computation.
+    try:
+        return await asyncio.wait_for(
+            asyncio.shield(future), _deadlines.get_remaining()
+        )
+    except TimeoutError as e:
+        raise _deadlines.DeadlineExceeded(
+            "The deadline passed while waiting on an identical request"
+        ) from e
+
+
+def _remove(key: str, future: asyncio.Future):
+    if _in_flight.get(key) is future:
+        del _in_flight[key]
+
+
+async def _create_with_process_lock(
+    key: str,
+    create: Callable[[], Awaitable[Any]],
+    load: Callable[[], Awaitable[Any]],
+):
+    offset, waited = await _acquire_process_lock(key)
+
+    try:
+        if waited:
+            result = await load()
+            if result is not None:
+                stats.increment("cross_process_coalesced")
+                _release_process_lock(offset)
+
+                return result
+
+        result = await create()
+    except BaseException:
+        _release_process_lock(offset)
+        raise
+
+    # The result is returned straight away, but the other processes keep
+    # waiting until the write-behind queue has put the record in the store.
+    pending_write = writer.get_pending_write(key)
+
+    if pending_write is None:
+        _release_process_lock(offset)
+    else:
+        pending_write.add_done_callback(lambda _: _release_process_lock(offset))
+
+    return result
+
+
+async def _acquire_process_lock(key: str):
+    # POSIX record locks on a single shared file, one byte per key, so that
+    # no lock files are created per request. The byte offset is derived from
+    # the key so that any key format can be locked.
+    file_descriptor = _get_lock_file_descriptor()
+    offset = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=7).digest())
+
+    waited = False
+    interval = LOCK_POLL_INITIAL_INTERVAL
+
+    while True:
+        try:
+            fcntl.lockf(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            return offset, waited
+        except OSError:
+            waited = True
+
+        remaining = _deadlines.get_remaining()
+
+        if remaining is None:
+            await asyncio.sleep(interval)
+        elif remaining <= 0:
+            raise _deadlines.DeadlineExceeded(
+                "The deadline passed while waiting on another process's request"
+            )
+        else:
+            await asyncio.sleep(min(interval, remaining))
+
+        interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
+
+
+def _release_process_lock(offset: int):
+    fcntl.lockf(_get_lock_file_descriptor(), fcntl.LOCK_UN, 1, offset)
+
+
+def _get_lock_file_descriptor():
+    global _lock_file_descriptor  # pylint: disable = global-statement
+
+    if _lock_file_descriptor is None:
+        COMPLETION_CACHE_LOCK.parent.mkdir(parents=True, exist_ok=True)
+        _lock_file_descriptor = os.open(COMPLETION_CACHE_LOCK, os.O_RDWR | os.O_CREAT)
+
+    return _lock_file_descriptor
@@ -0,0 +1,99 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+from typing import Any, Literal
+
+from assistance._utilities import get_hash_digest
+
+# Bump whenever the normalisation or the request encoding below changes,
+# so that records computed under the old rules are not reused.
+SCHEMA_VERSION = 1
+
+Namespace = Literal["completion", "embedding"]
+
+
+def completion_key(request: dict[str, Any]) -> str:
+    """The cache key for a completion request, excluding the api key."""
+
+    parameters = {key: value for key, value in request.items() if key != "prompt"}
+    model = parameters.get("engine", parameters.get("model"))
+
+    # The prompt is hashed directly rather than via JSON so that very long
+    # prompts are not first escaped and copied.
+    hasher = _new_hasher()
+    hasher.update(
+        json.dumps(parameters, sort_keys=True, separators=(",", ":")).encode()
+    )
+    hasher.update(b"\x00")
+    hasher.update(normalise_prompt(request["prompt"]).encode())
+
+    return _format_key("completion", model, hasher.hexdigest())
+
+
+def embedding_key(text: str, model: str, api_base: str | None = None) -> str:
+    """The cache key for an embedding. Embeddings from an API other than
+    OpenAI's are given an api_base so that they are kept separate."""
+
+    hasher = _new_hasher()
+
+    if api_base is not None:
+        hasher.update(api_base.encode())
+        hasher.update(b"\x00")
+
+    hasher.update(normalise_embedding_text(text).encode())
+
+    return _format_key("embedding", model, hasher.hexdigest())
+
+
+def legacy_completion_key(request: dict[str, Any]) -> str:
+    return get_hash_digest(json.dumps(request, indent=2, sort_keys=True))
+
+
+def legacy_embedding_key(text: str) -> str:
+    return get_hash_digest(text)
+
+
+def get_namespace(key: str) -> str:
+    if ":" not in key:
+        return "legacy"
+
+    return key.split(":", 1)[0]
+
+
+def get_digest(key: str) -> str:
+    return key.rsplit(":", 1)[-1]
+
+
+def normalise_prompt(prompt: str) -> str:
+    """Line endings and trailing whitespace never change what is asked."""
+
+    lines = prompt.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def normalise_embedding_text(text: str) -> str:
+    # Newlines and runs of whitespace carry no meaning for the embedding
+    # of a question.
+    return " ".join(text.split())
+
+
+def _new_hasher():
+    return hashlib.blake2b(digest_size=28)
+
+
+def _format_key(namespace: Namespace, model: str, digest: str):
+    return f"{namespace}:{model}:v{SCHEMA_VERSION}:{digest}"
@@ -0,0 +1,175 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import time
+from typing import TypedDict
+
+from assistance._config import COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_TTLS
+
+from . import stats
+from .store import SqliteStore, get_store
+
+PRUNE_BATCH_SIZE = 1000
+DAY = 24 * 60 * 60
+
+AGE_BUCKETS = [
+    ("1 day", DAY),
+    ("1 week", 7 * DAY),
+    ("1 month", 30 * DAY),
+    ("3 months", 90 * DAY),
+    ("1 year", 365 * DAY),
+    ("older", float("inf")),
+]
+
+
+class NamespaceReport(TypedDict):
+    entries: int
+    bytes: int
+
+
+class CacheReport(TypedDict):
+    file_bytes: int
+    namespaces: dict[str, NamespaceReport]
+    hit_rates: dict[str, float | None]
+    json_repairs: dict[str, int]
+    created_ages: dict[str, int]
+    accessed_ages: dict[str, int]
+
+
+def get_sqlite_store() -> SqliteStore:
+    store = get_store()
+
+    if not isinstance(store, SqliteStore):
+        raise ValueError("Cache maintenance is only supported by the sqlite backend")
+
+    return store
+
+
+def get_report(store: SqliteStore) -> CacheReport:
+    store.flush_access_log()
+    now = time.time()
+
+    with store.connection() as connection:
+        namespaces: dict[str, NamespaceReport] = {
+            namespace: {"entries": entries, "bytes": size}
+            for namespace, entries, size in connection.execute(
+                "SELECT namespace, COUNT(*), SUM(size) FROM cache GROUP BY namespace"
+            )
+        }
+        counts = collections.Counter(
+            dict(connection.execute("SELECT name, value FROM counters").fetchall())
+        )
+        created_ages = _get_age_histogram(connection, "created", now)
+        accessed_ages = _get_age_histogram(connection, "accessed", now)
+
+    file_bytes = sum(
+        path.stat().st_size
+        for path in store.path.parent.glob(f"{store.path.name}*")
+        if path.is_file()
+    )
+
+    return {
+        "file_bytes": file_bytes,
+        "namespaces": namespaces,
+        "hit_rates": stats.get_hit_rates(counts),
+        "json_repairs": stats.get_json_repair_counts(counts),
+        "created_ages": created_ages,
+        "accessed_ages": accessed_ages,
+    }
+
+
+def prune(
+    store: SqliteStore,
+    max_bytes: int = COMPLETION_CACHE_MAX_BYTES,
+    ttls: dict[str, float | None] | None = None,
+):
+    """Remove expired records, and then the least recently accessed records
+    until the store is within its byte budget."""
+
+    if ttls is None:
+        ttls = COMPLETION_CACHE_TTLS
+
+    store.flush_access_log()
+    now = time.time()
+
+    expired = 0
+    evicted = 0
+
+    with store.connection() as connection:
+        with connection:
+            for namespace, ttl in ttls.items():
+                if ttl is None:
+                    continue
+
+                expired += connection.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND created < ?",
+                    (namespace, now - ttl),
+                ).rowcount
+
+        (total_bytes,) = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+
+    while total_bytes > max_bytes:
+        with store.connection() as connection:
+            rows = connection.execute(
+                "SELECT key, size FROM cache ORDER BY accessed LIMIT ?",
+                (PRUNE_BATCH_SIZE,),
+            ).fetchall()
+
+            if not rows:
+                break
+
+            to_delete = []
+            for key, size in rows:
+                if total_bytes <= max_bytes:
+                    break
+
+                to_delete.append((key,))
+                total_bytes -= size
+
+            with connection:
+                connection.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+
+        evicted += len(to_delete)
+
+    logging.info(f"Pruned completion cache: {expired} expired, {evicted} evicted")
+
+    return expired, evicted
+
+
+def compact(store: SqliteStore):
+    """Return the space freed by pruning to the file system."""
+
+    with store.connection() as connection:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("VACUUM")
+
+
+def _get_age_histogram(connection, column: str, now: float):
+    histogram = {}
+    lower = 0.0
+
+    for label, upper in AGE_BUCKETS:
+        (count,) = connection.execute(
+            f"SELECT COUNT(*) FROM cache WHERE {column} <= ? AND {column} > ?",
+            (now - lower, now - upper),
+        ).fetchone()
+
+        histogram[label] = count
+        lower = upper
+
+    return histogram
@@ -0,0 +1,46 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any
+
+from cachetools import LRUCache
+
+from assistance._config import MEMORY_CACHE_BYTES
+
+from . import stats
+
+# Values are stored as (encoded size in bytes, decoded record) so that the LRU
+# budget is accounted in bytes rather than in number of entries.
+_cache: LRUCache[str, tuple[int, Any]] = LRUCache(
+    maxsize=MEMORY_CACHE_BYTES, getsizeof=lambda value: value[0]
+)
+
+
+def get(key: str):
+    try:
+        _size, value = _cache[key]
+    except KeyError:
+        stats.increment("memory_misses")
+        return None
+
+    stats.increment("memory_hits")
+
+    return value
+
+
+def put(key: str, value: Any, size: int):
+    if size > _cache.maxsize:
+        return
+
+    _cache[key] = (size, value)
@@ -0,0 +1,67 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+
+# The number of times that each JSON repair was needed for a response to
+# parse is kept alongside the cache's own counters, as "json_repair:<name>".
+JSON_REPAIR_PREFIX = "json_repair:"
+
+counters: collections.Counter[str] = collections.Counter()
+_persisted: collections.Counter[str] = collections.Counter()
+
+# The counters are incremented on the event loop, but persisted from the
+# store's flush, which runs within a worker thread.
+_lock = threading.Lock()
+
+
+def increment(name: str, amount: int = 1):
+    with _lock:
+        counters[name] += amount
+
+
+def take_unpersisted():
+    """The counts accumulated since the previous call, for adding to the
+    totals kept within the cache store."""
+
+    with _lock:
+        deltas = counters - _persisted
+        _persisted.update(deltas)
+
+    return deltas
+
+
+def get_hit_rates(counts: collections.Counter[str] | None = None):
+    if counts is None:
+        with _lock:
+            counts = counters.copy()
+
+    hit_rates = {}
+
+    for tier in ("memory", "disk"):
+        hits = counts[f"{tier}_hits"]
+        lookups = hits + counts[f"{tier}_misses"]
+
+        hit_rates[tier] = hits / lookups if lookups else None
+
+    return hit_rates
+
+
+def get_json_repair_counts(counts: collections.Counter[str]):
+    return {
+        name.removeprefix(JSON_REPAIR_PREFIX): count
+        for name, count in sorted(counts.items())
+        if name.startswith(JSON_REPAIR_PREFIX)
+    }
@@ -0,0 +1,376 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Iterator, Protocol
+
+from assistance._config import COMPLETION_CACHE_BACKEND
+from assistance._paths import (
+    COMPLETION_CACHE,
+    COMPLETION_CACHE_DB,
+    get_completion_cache_path,
+)
+
+from . import codec, keys, stats
+
+MIGRATION_BATCH_SIZE = 1000
+ACCESS_FLUSH_INTERVAL = 60
+SCHEMA_VERSION = 2
+
+
+class CacheStore(Protocol):
+    def get(self, key: str) -> bytes | None:
+        ...
+
+    def set(self, key: str, value: bytes) -> None:
+        ...
+
+    def set_many(self, items: list[tuple[str, bytes]]) -> None:
+        ...
+
+    def items(self) -> Iterator[tuple[str, bytes]]:
+        ...
+
+    def touch(self, key: str) -> None:
+        ...
+
+    def flush_access_log(self) -> None:
+        ...
+
+
+async def load(key: str) -> bytes | None:
+    return await asyncio.to_thread(get_store().get, key)
+
+
+def touch(key: str):
+    get_store().touch(key)
+
+
+@functools.cache
+def get_store() -> CacheStore:
+    if COMPLETION_CACHE_BACKEND == "directory":
+        return DirectoryStore(COMPLETION_CACHE)
+
+    if COMPLETION_CACHE_BACKEND == "sqlite":
+        return SqliteStore(COMPLETION_CACHE_DB, legacy=DirectoryStore(COMPLETION_CACHE))
+
+    raise ValueError(f"Unknown completion cache backend: {COMPLETION_CACHE_BACKEND}")
+
+
+class DirectoryStore:
+    """The original layout, one JSON file per hash sharded over two levels."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Written to a temporary file and then renamed into place so that an
+        # interrupted write can never leave a truncated record behind.
+        temporary_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+        with open(temporary_path, "wb") as f:
+            f.write(value)
+
+        os.replace(temporary_path, path)
+
+    def set_many(self, items: list[tuple[str, bytes]]):
+        for key, value in items:
+            self.set(key, value)
+
+    def items(self) -> Iterator[tuple[str, bytes]]:
+        for path in self.root.rglob("*.json"):
+            namespace = path.relative_to(self.root).parts[:-3]
+
+            with open(path, "rb") as f:
+                yield ":".join([*namespace, path.stem]), f.read()
+
+    def touch(self, key: str):
+        pass
+
+    def flush_access_log(self):
+        pass
+
+    def _path(self, key: str):
+        # Namespaced keys are laid out as directories, with the digest at
+        # the end sharded the same way as the legacy bare hashes.
+        *namespace, digest = key.split(":")
+
+        if self.root == COMPLETION_CACHE and not namespace:
+            return get_completion_cache_path(digest)
+
+        return self.root.joinpath(
+            *namespace, digest[0:4], digest[4:8], f"{digest}.json"
+        )
+
+
+class SqliteStore:
+    """All cache records within a single SQLite file, indexed by key.
+
+    When a legacy directory store is provided, misses of legacy
+    (unnamespaced) keys fall through to it and any record found there is
+    copied across. Namespaced keys were never stored within that layout.
+    """
+
+    def __init__(self, path: pathlib.Path, legacy: DirectoryStore | None = None):
+        self.path = path
+        self.legacy = legacy
+
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+        # Last access times are only written out periodically, rather than
+        # turning every cache hit into a write.
+        self._access_lock = threading.Lock()
+        self._accessed: dict[str, float] = {}
+        self._last_access_flush = time.monotonic()
+
+    def get(self, key: str) -> bytes | None:
+        with self.connection() as connection:
+            row = connection.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is not None:
+            self.touch(key)
+
+            if time.monotonic() - self._last_access_flush > ACCESS_FLUSH_INTERVAL:
+                self.flush_access_log()
+
+            return row[0]
+
+        if self.legacy is None or keys.get_namespace(key) != "legacy":
+            return None
+
+        value = self.legacy.get(key)
+        if value is None:
+            return None
+
+        try:
+            value = codec.encode_legacy(value)
+        except (ValueError, KeyError, IndexError):
+            return None
+
+        self.set(key, value)
+
+        return value
+
+    def set(self, key: str, value: bytes):
+        self.set_many([(key, value)])
+
+    def set_many(self, items: list[tuple[str, bytes]]):
+        now = time.time()
+        rows = [
+            (key, value, keys.get_namespace(key), len(value), now, now)
+            for key, value in items
+        ]
+
+        with self.connection() as connection:
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO cache "
+                    "(key, value, namespace, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+
+        self.flush_access_log()
+
+    def touch(self, key: str):
+        with self._access_lock:
+            self._accessed[key] = time.time()
+
+    def flush_access_log(self):
+        with self._access_lock:
+            accessed, self._accessed = self._accessed, {}
+            self._last_access_flush = time.monotonic()
+
+        counter_deltas = stats.take_unpersisted()
+
+        if not accessed and not counter_deltas:
+            return
+
+        with self.connection() as connection:
+            with connection:
+                connection.executemany(
+                    "UPDATE cache SET accessed = ? WHERE key = ?",
+                    [(timestamp, key) for key, timestamp in accessed.items()],
+                )
+                connection.executemany(
+                    "INSERT INTO counters (name, value) VALUES (?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                    list(counter_deltas.items()),
+                )
+
+    def items(self) -> Iterator[tuple[str, bytes]]:
+        last_key = ""
+
+        while True:
+            with self.connection() as connection:
+                rows = connection.execute(
+                    "SELECT key, value FROM cache WHERE key > ? ORDER BY key LIMIT ?",
+                    (last_key, MIGRATION_BATCH_SIZE),
+                ).fetchall()
+
+            if not rows:
+                return
+
+            yield from rows
+            last_key = rows[-1][0]
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._lock:
+            if self._connection is None:
+                self._connection = self._connect()
+
+            yield self._connection
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # All API workers share this file, WAL allows their reads to
+        # continue while another worker is writing.
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+
+        with connection:
+            _migrate_schema(connection)
+
+        return connection
+
+
+def _migrate_schema(connection: sqlite3.Connection):
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+
+    if version >= SCHEMA_VERSION:
+        return
+
+    # Taken before the version is read again, so that of several workers
+    # starting at once only the first migrates and the rest see its result.
+    connection.execute("BEGIN IMMEDIATE")
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+
+    if version < 1:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)"
+        )
+
+    if version < 2:
+        existing_columns = {
+            row[1] for row in connection.execute("PRAGMA table_info(cache)")
+        }
+
+        for column in (
+            "namespace TEXT NOT NULL DEFAULT 'legacy'",
+            "size INTEGER NOT NULL DEFAULT 0",
+            "created REAL NOT NULL DEFAULT 0",
+            "accessed REAL NOT NULL DEFAULT 0",
+        ):
+            if column.split(" ")[0] not in existing_columns:
+                connection.execute(f"ALTER TABLE cache ADD COLUMN {column}")
+
+        connection.execute(
+            "UPDATE cache SET "
+            "namespace = CASE WHEN instr(key, ':') > 0 "
+            "THEN substr(key, 1, instr(key, ':') - 1) ELSE 'legacy' END, "
+            "size = length(value), "
+            "created = CAST(strftime('%s', 'now') AS REAL), "
+            "accessed = CAST(strftime('%s', 'now') AS REAL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS cache_namespace_created "
+            "ON cache (namespace, created)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS counters "
+            "(name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def migrate_directory_to_sqlite(
+    source: pathlib.Path = COMPLETION_CACHE,
+    destination: pathlib.Path = COMPLETION_CACHE_DB,
+    remove_source: bool = False,
+):
+    source_store = DirectoryStore(source)
+    destination_store = SqliteStore(destination)
+
+    migrated = 0
+    skipped = 0
+    batch: list[tuple[str, bytes]] = []
+    migrated_paths: list[pathlib.Path] = []
+
+    for path in source.glob("*/*/*.json"):
+        with open(path, "rb") as f:
+            value = f.read()
+
+        # Truncated writes have always been read as a miss, so there is no
+        # point in carrying them across.
+        try:
+            value = codec.encode_legacy(value)
+        except (ValueError, KeyError, IndexError):
+            skipped += 1
+            continue
+
+        batch.append((path.stem, value))
+        migrated_paths.append(path)
+
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            destination_store.set_many(batch)
+            migrated += len(batch)
+            batch = []
+
+            logging.info(f"Migrated {migrated} cache records")
+
+    if batch:
+        destination_store.set_many(batch)
+        migrated += len(batch)
+
+    if remove_source:
+        for path in migrated_paths:
+            os.remove(path)
+
+        _remove_empty_directories(source_store.root)
+
+    return migrated, skipped
+
+
+def _remove_empty_directories(root: pathlib.Path):
+    for directory in sorted(root.glob("*/*"), reverse=True) + sorted(root.glob("*")):
+        if directory.is_dir() and not any(directory.iterdir()):
+            directory.rmdir()
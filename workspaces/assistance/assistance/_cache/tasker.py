@@ -0,0 +1,25 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import aiocron
+
+from . import maintenance
+
+
+@aiocron.crontab("0 3 * * *")
+async def tasker_cache_prune():
+    store = maintenance.get_sqlite_store()
+    await asyncio.to_thread(maintenance.prune, store)
@@ -0,0 +1,87 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+
+from assistance._config import CACHE_WRITE_BATCH_SIZE, CACHE_WRITE_QUEUE_SIZE
+
+from . import stats, store
+
+_queue: asyncio.Queue[tuple[str, bytes]] | None = None
+_worker: asyncio.Task | None = None
+_pending: dict[str, asyncio.Future] = {}
+
+
+async def enqueue(key: str, value: bytes):
+    """Queue a cache record to be written in the background.
+
+    The queue is bounded, so when the store falls behind, callers wait
+    here rather than piling up an unbounded number of writes.
+    """
+
+    queue = _get_queue()
+
+    previous = _pending.get(key)
+    if previous is None or previous.done():
+        _pending[key] = asyncio.get_running_loop().create_future()
+
+    await queue.put((key, value))
+
+
+def get_pending_write(key: str) -> asyncio.Future | None:
+    """A future that resolves once the record for this key is in the store."""
+
+    return _pending.get(key)
+
+
+async def flush():
+    if _queue is not None:
+        await _queue.join()
+
+    await asyncio.to_thread(store.get_store().flush_access_log)
+
+
+def _get_queue():
+    global _queue, _worker  # pylint: disable = global-statement
+
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=CACHE_WRITE_QUEUE_SIZE)
+
+    if _worker is None or _worker.done():
+        _worker = asyncio.create_task(_write_queued_records(_queue))
+
+    return _queue
+
+
+async def _write_queued_records(queue: asyncio.Queue[tuple[str, bytes]]):
+    while True:
+        batch = [await queue.get()]
+
+        while len(batch) < CACHE_WRITE_BATCH_SIZE and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        try:
+            await asyncio.to_thread(store.get_store().set_many, batch)
+        except Exception:  # pylint: disable = broad-except
+            stats.increment("write_errors", len(batch))
+            logging.exception(f"Failed to write {len(batch)} cache records")
+
+        for key, _ in batch:
+            # Resolved even on failure, a missing record is only a cache miss
+            future = _pending.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+            queue.task_done()
@@ -180,7 +180,7 @@ async def _create_and_send_email_with_signature(
         "data": b64_message,
     }
 
-    return await _ctx.session.post(
+    return await _ctx.get_session().post(
         url=POSTAL_RAW_API_URL,
         headers=headers,
         data=json.dumps(postal_data),
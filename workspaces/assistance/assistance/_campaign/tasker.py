@@ -21,6 +21,7 @@ import aiocron
 from assistance._campaign import send
 from assistance._git import pull, push
 from assistance._paths import SYNCED_JIMS_REPO
+from assistance._scheduler import priority
 
 from . import stats
 
@@ -30,7 +31,9 @@ async def run_campaign():
     logging.info("Running campaign")
 
     pull()
-    await _campaign()
+
+    with priority("background"):
+        await _campaign()
 
     stats.run_stats()
 
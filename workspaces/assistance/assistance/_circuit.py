@@ -0,0 +1,135 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Awaitable, Callable, Literal
+
+import openai.error
+
+from assistance._config import (
+    CIRCUIT_ERROR_RATE,
+    CIRCUIT_MAX_OPEN_SECONDS,
+    CIRCUIT_MIN_CALLS,
+    CIRCUIT_OPEN_SECONDS,
+    CIRCUIT_WINDOW,
+)
+
+State = Literal["closed", "open", "half_open"]
+
+# The errors that indicate the API itself is failing, rather than a
+# problem with the request or the account's rate limit. The builtin
+# TimeoutError is left out, as it is also raised by waits that are not the
+# API's doing, such as queueing for admission or an email's deadline.
+OUTAGE_ERRORS = (
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops requests being sent once the API has a sustained error rate.
+
+    While open every request fails immediately with CircuitOpen. After a
+    pause a single probe request is sent (the half open state). When it
+    succeeds the circuit closes and the close callbacks are run, otherwise
+    the circuit reopens for twice as long.
+    """
+
+    def __init__(self, probe: Callable[[], Awaitable[object]]):
+        self.state: State = "closed"
+        self._probe = probe
+        self._outcomes: collections.deque[tuple[float, bool]] = collections.deque()
+        self._open_seconds = CIRCUIT_OPEN_SECONDS
+        self._probe_task: asyncio.Task | None = None
+        self._close_callbacks: list[Callable[[], Awaitable[object]]] = []
+
+    def check(self):
+        if self.state != "closed":
+            raise CircuitOpen(f"The OpenAI circuit breaker is {self.state}")
+
+    def record(self, error: BaseException | None):
+        if error is not None and not isinstance(error, OUTAGE_ERRORS):
+            return
+
+        now = time.monotonic()
+        self._outcomes.append((now, error is not None))
+
+        while self._outcomes[0][0] < now - CIRCUIT_WINDOW:
+            self._outcomes.popleft()
+
+        if self.state != "closed" or len(self._outcomes) < CIRCUIT_MIN_CALLS:
+            return
+
+        failures = sum(failed for _, failed in self._outcomes)
+        if failures / len(self._outcomes) >= CIRCUIT_ERROR_RATE:
+            self._open()
+
+    def add_close_callback(self, callback: Callable[[], Awaitable[object]]):
+        """Run the callback each time the circuit closes after an outage."""
+
+        self._close_callbacks.append(callback)
+
+    def _open(self):
+        logging.warning(
+            f"Opening the OpenAI circuit breaker for {self._open_seconds}s after "
+            f"{len(self._outcomes)} requests with a sustained error rate"
+        )
+
+        self.state = "open"
+        self._outcomes.clear()
+        self._probe_task = asyncio.create_task(self._probe_until_recovered())
+
+    async def _probe_until_recovered(self):
+        while True:
+            await asyncio.sleep(self._open_seconds)
+
+            self.state = "half_open"
+
+            try:
+                await self._probe()
+            except Exception:  # pylint: disable = broad-except
+                self._open_seconds = min(
+                    2 * self._open_seconds, CIRCUIT_MAX_OPEN_SECONDS
+                )
+                self.state = "open"
+
+                logging.warning(
+                    "OpenAI circuit breaker probe failed, reopening for "
+                    f"{self._open_seconds}s",
+                    exc_info=True,
+                )
+                continue
+
+            break
+
+        logging.info("OpenAI circuit breaker probe succeeded, closing")
+
+        self.state = "closed"
+        self._open_seconds = CIRCUIT_OPEN_SECONDS
+
+        for callback in self._close_callbacks:
+            try:
+                await callback()
+            except Exception:  # pylint: disable = broad-except
+                logging.exception("Circuit breaker close callback failed")
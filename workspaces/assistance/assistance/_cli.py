@@ -27,6 +27,8 @@ logging.basicConfig(
 )
 
 app = typer.Typer()
+cache_app = typer.Typer()
+app.add_typer(cache_app, name="cache")
 
 
 @app.command()
@@ -44,13 +46,41 @@ def tasker():
 
 
 @app.command()
-def rerun(hash_digest: Annotated[Optional[str], typer.Argument()] = None):
+def rerun(
+    hash_digest: Annotated[Optional[str], typer.Argument()] = None,
+    openai_api_base: Annotated[
+        Optional[str],
+        typer.Option(help="Send requests to another OpenAI compatible API."),
+    ] = None,
+    dry_run: Annotated[
+        Optional[bool],
+        typer.Option(
+            "--dry-run/--send",
+            help="Log the emails rather than sending them. Defaults to a dry run with --openai-api-base.",
+            show_default=False,
+        ),
+    ] = None,
+):
+    if openai_api_base is not None:
+        from assistance._openai import set_api_base
+
+        set_api_base(openai_api_base)
+
+    if dry_run is None:
+        dry_run = openai_api_base is not None
+
+    if dry_run:
+        from assistance._postal import set_dry_run
+
+        set_dry_run()
+
     loop = asyncio.get_event_loop()
     loop.run_until_complete(_rerun_with_session(hash_digest))
 
 
 async def _rerun_with_session(hash_digest: str | None):
-    from assistance import _ctx
+    from assistance import _ctx, _telemetry
+    from assistance._cache import writer as _cache_writer
     from assistance._email.handler import rerun as _rerun
 
     _ctx.open_session()
@@ -58,12 +88,224 @@ async def _rerun_with_session(hash_digest: str | None):
     try:
         await _rerun(hash_digest)
     finally:
+        await _cache_writer.flush()
+        await _telemetry.flush()
         await _ctx.close_session()
 
 
 @app.command()
 def faq():
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_faq_update())
+
+
+async def _faq_update():
+    from assistance import _ctx, _telemetry
+    from assistance._cache import writer as _cache_writer
     from assistance._faq.tasker import run_faq_update
 
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(run_faq_update())
+    try:
+        await run_faq_update()
+    finally:
+        await _cache_writer.flush()
+        await _telemetry.flush()
+        await _ctx.close_session()
+
+
+@app.command()
+def fake_openai(
+    port: int = 8100,
+    latency: Annotated[
+        float, typer.Option(help="Seconds added to every request.")
+    ] = 0.5,
+    jitter: Annotated[
+        float, typer.Option(help="Fraction by which the latency varies.")
+    ] = 0.5,
+    rate_limit_rate: Annotated[
+        float, typer.Option(help="Fraction of requests that respond with a 429.")
+    ] = 0.0,
+    context_error_rate: Annotated[
+        float,
+        typer.Option(help="Fraction of completions that exceed the context length."),
+    ] = 0.0,
+    seed: int = 42,
+):
+    """Serve a local stand-in for the OpenAI API, for use with
+    --openai-api-base http://127.0.0.1:<port>/v1"""
+
+    from assistance._fake_openai import main as _main
+
+    _main(
+        {
+            "latency": latency,
+            "jitter": jitter,
+            "rate_limit_rate": rate_limit_rate,
+            "context_error_rate": context_error_rate,
+            "seed": seed,
+        },
+        port=port,
+    )
+
+
+@app.command()
+def telemetry(
+    days: Annotated[
+        Optional[float], typer.Option(help="Only include the most recent days.")
+    ] = None,
+    top: Annotated[
+        int, typer.Option(help="The number of costliest emails shown.")
+    ] = 10,
+):
+    import time
+
+    from assistance import _telemetry
+
+    since = 0.0 if days is None else time.time() - days * 24 * 60 * 60
+    summary = _telemetry.summarise(_telemetry.load_records(since=since))
+
+    typer.echo(
+        f"{'Stage':<20}{'Calls':>8}{'Misses':>8}{'p50 (s)':>10}{'p95 (s)':>10}"
+        f"{'Prompt':>12}{'Completion':>12}{'Cost ($)':>10}"
+    )
+    for stage, details in summary["stages"].items():
+        typer.echo(
+            f"{stage:<20}{details['calls']:>8}{details['misses']:>8}"
+            f"{details['p50_latency']:>10.2f}{details['p95_latency']:>10.2f}"
+            f"{details['prompt_tokens']:>12}{details['completion_tokens']:>12}"
+            f"{details['cost']:>10.4f}"
+        )
+
+    scope_costs = summary["scope_costs"]
+    if not scope_costs:
+        return
+
+    costs = sorted(scope_costs.values())
+    typer.echo(
+        f"\nCost per email: mean ${sum(costs) / len(costs):.3f}, "
+        f"median ${costs[len(costs) // 2]:.3f} over {len(costs)} emails"
+    )
+
+    typer.echo("\nCostliest emails:")
+    for scope, cost in sorted(
+        scope_costs.items(), key=lambda item: item[1], reverse=True
+    )[:top]:
+        typer.echo(f"  ${cost:.3f}  {scope}")
+
+
+@app.command()
+def benchmark_similarity(
+    sizes: Annotated[
+        str, typer.Option(help="Comma separated numbers of FAQ questions.")
+    ] = "100,1000,10000,100000",
+    queries: Annotated[int, typer.Option(help="Queries per search.")] = 5,
+    k: int = 3,
+    repeats: int = 50,
+    nprobe: Annotated[
+        Optional[int], typer.Option(help="Clusters searched by the IVF index.")
+    ] = None,
+):
+    from assistance._config import ANN_NPROBE
+    from assistance._similarity import benchmark
+
+    results = benchmark(
+        [int(size) for size in sizes.split(",")],
+        number_of_queries=queries,
+        k=k,
+        repeats=repeats,
+        nprobe=ANN_NPROBE if nprobe is None else nprobe,
+    )
+
+    typer.echo(
+        f"{'Method':<10}{'FAQs':>10}{'Mean (ms)':>12}{'p95 (ms)':>12}{'Recall':>10}"
+    )
+    for result in results:
+        typer.echo(
+            f"{result['method']:<10}{result['size']:>10}"
+            f"{result['mean_latency'] * 1000:>12.3f}"
+            f"{result['p95_latency'] * 1000:>12.3f}"
+            f"{result['recall']:>10.1%}"
+        )
+
+
+@cache_app.command("migrate")
+def cache_migrate(
+    remove_source: Annotated[
+        bool, typer.Option(help="Delete the JSON files once they are migrated.")
+    ] = False
+):
+    from assistance._cache.store import migrate_directory_to_sqlite
+
+    migrated, skipped = migrate_directory_to_sqlite(remove_source=remove_source)
+
+    logging.info(f"Migrated {migrated} cache records, skipped {skipped} corrupt files")
+
+
+@cache_app.command("stats")
+def cache_stats():
+    from assistance._cache import maintenance
+
+    report = maintenance.get_report(maintenance.get_sqlite_store())
+
+    typer.echo(f"File size: {_format_bytes(report['file_bytes'])}")
+
+    typer.echo("\nEntries:")
+    for namespace, details in sorted(report["namespaces"].items()):
+        typer.echo(
+            f"  {namespace}: {details['entries']} ({_format_bytes(details['bytes'])})"
+        )
+
+    typer.echo("\nHit rates:")
+    for tier, hit_rate in report["hit_rates"].items():
+        formatted = "n/a" if hit_rate is None else f"{hit_rate:.1%}"
+        typer.echo(f"  {tier}: {formatted}")
+
+    typer.echo("\nJSON repairs:")
+    for repair, count in report["json_repairs"].items():
+        typer.echo(f"  {repair}: {count}")
+
+    for title, histogram in [
+        ("Created within", report["created_ages"]),
+        ("Last accessed within", report["accessed_ages"]),
+    ]:
+        typer.echo(f"\n{title}:")
+        for label, count in histogram.items():
+            typer.echo(f"  {label}: {count}")
+
+
+@cache_app.command("prune")
+def cache_prune(
+    max_bytes: Annotated[
+        Optional[int], typer.Option(help="Override the configured byte budget.")
+    ] = None,
+    compact: Annotated[
+        bool, typer.Option(help="Compact the cache file after pruning.")
+    ] = False,
+):
+    from assistance._cache import maintenance
+
+    store = maintenance.get_sqlite_store()
+
+    if max_bytes is None:
+        maintenance.prune(store)
+    else:
+        maintenance.prune(store, max_bytes=max_bytes)
+
+    if compact:
+        maintenance.compact(store)
+
+
+@cache_app.command("compact")
+def cache_compact():
+    from assistance._cache import maintenance
+
+    maintenance.compact(maintenance.get_sqlite_store())
+
+
+def _format_bytes(size: float):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+
+        size /= 1024
+
+    return f"{size:.1f} TiB"
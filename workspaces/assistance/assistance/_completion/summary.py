@@ -16,12 +16,24 @@
 # https://github.com/hwchase17/langchain/blob/ae1b589f60a/langchain/agents/conversational/prompt.py#L1-L36
 
 
+import functools
+import json
 import textwrap
 
 from assistance._config import GPT_TURBO_SMALL_CONTEXT
 from assistance._openai import (
     get_completion_only,
     get_completion_test_for_json_decoding,
+    get_completion_with_schema,
+)
+from assistance._telemetry import stage
+from assistance._tokens import (
+    count_prompt_tokens,
+    count_tokens,
+    get_largest_model,
+    get_prompt_budget,
+    prompt_fits,
+    truncate_to_tokens,
 )
 
 SUMMARY_KWARGS = {
@@ -64,9 +76,8 @@ SUMMARY_PROMPT_WITHOUT_INSTRUCTIONS = textwrap.dedent(
 ).strip()
 
 
-MAX_MODEL_TOKENS = 4096
-
-SUMMARY_BATCH_SIZE = 2
+SUMMARY_ITEM_TEMPLATE = "Summary of omitted emails:\n{summary}\n\n"
+TRANSCRIPT_SEPARATOR = "\n\n"
 
 
 async def completion_on_thread_with_summary_fallback(
@@ -76,17 +87,58 @@ async def completion_on_thread_with_summary_fallback(
     api_key: str,
     instructions: str | None = None,
     test_json: bool = False,
+    schema: dict | None = None,
     **kwargs,
 ):
-    if test_json:
+    if schema is not None:
+        completion_function_to_use = functools.partial(
+            get_completion_with_schema, schema
+        )
+    elif test_json:
         completion_function_to_use = get_completion_test_for_json_decoding
     else:
         completion_function_to_use = get_completion_only
 
+    # The completion layer routes to a larger context model whenever the
+    # prompt needs it, so emails only need summarising once the thread no
+    # longer fits within the largest.
+    model = get_largest_model(kwargs["engine"])
+    max_tokens = kwargs["max_tokens"]
+    previous_transcript_tokens = None
+
+    # The function definition that carries a schema also counts towards the
+    # prompt tokens.
+    if schema is not None:
+        max_tokens += count_tokens(json.dumps(schema), model)
+
     while True:
-        transcript = "\n\n".join(email_thread)
+        transcript = TRANSCRIPT_SEPARATOR.join(email_thread)
         prompt_with_transcript = prompt.replace("{transcript}", transcript)
 
+        if not prompt_fits(prompt_with_transcript, model, max_tokens):
+            # Every pass is required to shorten the thread, so that it cannot
+            # summarise forever.
+            transcript_tokens = count_tokens(transcript, model)
+            if (
+                previous_transcript_tokens is not None
+                and transcript_tokens >= previous_transcript_tokens
+            ):
+                raise ValueError("Model maximum reached")
+
+            previous_transcript_tokens = transcript_tokens
+
+            email_thread = await _summarise_oldest_emails(
+                scope=scope,
+                prompt=prompt,
+                email_thread=email_thread,
+                api_key=api_key,
+                instructions=instructions,
+                model=model,
+                max_tokens=max_tokens,
+            )
+
+            continue
+
         try:
             response = await completion_function_to_use(
                 scope=scope,
@@ -95,32 +147,127 @@ async def completion_on_thread_with_summary_fallback(
                 **kwargs,
             )
         except ValueError as e:
-            if "Model maximum reached" not in str(e):
+            if "Model maximum reached" not in str(e) or len(email_thread) < 2:
                 raise e
 
-            transcript_to_summarise = "\n\n".join(email_thread[0:SUMMARY_BATCH_SIZE])
-
-            if instructions:
-                summary_prompt = SUMMARY_PROMPT_WITH_INSTRUCTIONS.format(
-                    transcript=transcript_to_summarise, instructions=instructions
-                )
-            else:
-                summary_prompt = SUMMARY_PROMPT_WITHOUT_INSTRUCTIONS.format(
-                    transcript=transcript_to_summarise
-                )
-
-            summary = await get_completion_only(
-                scope=scope,
-                prompt=summary_prompt,
-                api_key=api_key,
-                **SUMMARY_KWARGS,
+            # The token budget should make this unreachable, it remains in
+            # case the budget is ever underestimated.
+            email_thread = (
+                await _summarise(scope, email_thread[0:2], api_key, instructions)
+                + email_thread[2:]
             )
 
-            summary_item = f"Summary of omitted emails:\n{summary}\n\n"
-            email_thread = [summary_item] + email_thread[SUMMARY_BATCH_SIZE:]
-
             continue
 
         break
 
     return response, transcript
+
+
+async def _summarise_oldest_emails(
+    scope: str,
+    prompt: str,
+    email_thread: list[str],
+    api_key: str,
+    instructions: str | None,
+    model: str,
+    max_tokens: int,
+):
+    """Summarise, in a single call, just enough of the oldest emails for
+    the rest of the thread along with the summary to fit the prompt."""
+
+    available = get_prompt_budget(model, max_tokens) - count_prompt_tokens(
+        prompt.replace("{transcript}", ""), model
+    )
+    summary_allowance = SUMMARY_KWARGS["max_tokens"] + count_tokens(
+        SUMMARY_ITEM_TEMPLATE.format(summary=""), model
+    )
+
+    if summary_allowance > available or not email_thread:
+        raise ValueError("Model maximum reached")
+
+    # The emails handed to the summary call are themselves limited by the
+    # summary model's context.
+    summary_model = SUMMARY_KWARGS["engine"]
+    summary_available = get_prompt_budget(
+        summary_model, SUMMARY_KWARGS["max_tokens"]
+    ) - count_prompt_tokens(_get_summary_prompt("", instructions), summary_model)
+
+    email_tokens = [
+        count_tokens(email + TRANSCRIPT_SEPARATOR, model) for email in email_thread
+    ]
+    summary_email_tokens = [
+        count_tokens(email + TRANSCRIPT_SEPARATOR, summary_model)
+        for email in email_thread
+    ]
+
+    remaining_tokens = sum(email_tokens)
+    summarised_tokens = 0
+    number_to_summarise = 0
+    truncate_next = False
+
+    for tokens, summary_tokens in zip(email_tokens, summary_email_tokens):
+        if summary_allowance + remaining_tokens <= available:
+            break
+
+        if number_to_summarise > 0 and (
+            summarised_tokens + summary_tokens > summary_available
+        ):
+            # The thread still does not fit, so this email is summarised too,
+            # cut down to what the summary call has room for. Otherwise a
+            # summary followed by an oversized email would only ever be
+            # replaced by a summary of itself.
+            truncate_next = True
+            break
+
+        remaining_tokens -= tokens
+        summarised_tokens += summary_tokens
+        number_to_summarise += 1
+
+    # Separately counted emails can come in marginally under the budget that
+    # the whole prompt did not fit within.
+    number_to_summarise = max(number_to_summarise, 1)
+    emails_to_summarise = email_thread[0:number_to_summarise]
+
+    if number_to_summarise == 1:
+        emails_to_summarise = [
+            truncate_to_tokens(emails_to_summarise[0], summary_model, summary_available)
+        ]
+        summarised_tokens = min(summarised_tokens, summary_available)
+
+    if truncate_next:
+        emails_to_summarise.append(
+            truncate_to_tokens(
+                email_thread[number_to_summarise],
+                summary_model,
+                summary_available - summarised_tokens,
+            )
+        )
+        number_to_summarise += 1
+
+    summary_item = await _summarise(scope, emails_to_summarise, api_key, instructions)
+
+    return summary_item + email_thread[number_to_summarise:]
+
+
+async def _summarise(
+    scope: str, emails: list[str], api_key: str, instructions: str | None
+):
+    with stage("summary"):
+        summary = await get_completion_only(
+            scope=scope,
+            prompt=_get_summary_prompt(TRANSCRIPT_SEPARATOR.join(emails), instructions),
+            api_key=api_key,
+            **SUMMARY_KWARGS,
+        )
+
+    return [SUMMARY_ITEM_TEMPLATE.format(summary=summary)]
+
+
+def _get_summary_prompt(transcript: str, instructions: str | None):
+    if instructions:
+        return SUMMARY_PROMPT_WITH_INSTRUCTIONS.format(
+            transcript=transcript, instructions=instructions
+        )
+
+    return SUMMARY_PROMPT_WITHOUT_INSTRUCTIONS.format(transcript=transcript)
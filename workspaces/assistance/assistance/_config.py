@@ -15,15 +15,192 @@
 import json
 import pathlib
 import tomllib
-from typing import TypedDict, cast
+from typing import Literal, TypedDict, cast
 
 import aiofiles
 
 from assistance._paths import SYNCED_FAQS_STORE
 
+# Requests can be sent to any OpenAI compatible API instead, such as the
+# local stand-in served by `assistance fake-openai`.
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
 GPT_TURBO_SMALL_CONTEXT = "gpt-3.5-turbo-0613"
 GPT_TURBO_LARGE_CONTEXT = "gpt-3.5-turbo-16k"
 GPT_SOTA = "gpt-4-0613"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# The number of tokens that each model can attend to, shared between the
+# prompt and the completion's max_tokens.
+MODEL_CONTEXT_SIZES = {
+    GPT_TURBO_SMALL_CONTEXT: 4096,
+    GPT_TURBO_LARGE_CONTEXT: 16384,
+    GPT_SOTA: 8192,
+    EMBEDDING_MODEL: 8191,
+}
+
+# Requests for a model are sent to the first model within its route whose
+# context fits the prompt, so smaller (cheaper and faster) models are used
+# whenever they can be.
+MODEL_ROUTES = {
+    GPT_TURBO_SMALL_CONTEXT: [GPT_TURBO_SMALL_CONTEXT, GPT_TURBO_LARGE_CONTEXT],
+    GPT_TURBO_LARGE_CONTEXT: [GPT_TURBO_LARGE_CONTEXT],
+    GPT_SOTA: [GPT_SOTA],
+}
+
+
+class Price(TypedDict):
+    prompt: float
+    completion: float
+
+
+# US dollars per thousand tokens, used to estimate the cost of each email
+# from the recorded telemetry.
+OPENAI_PRICES: dict[str, Price] = {
+    GPT_TURBO_SMALL_CONTEXT: {"prompt": 0.0015, "completion": 0.002},
+    GPT_TURBO_LARGE_CONTEXT: {"prompt": 0.003, "completion": 0.004},
+    GPT_SOTA: {"prompt": 0.03, "completion": 0.06},
+    EMBEDDING_MODEL: {"prompt": 0.0001, "completion": 0},
+}
+
+# Each email's reply is to be written within this many seconds. Each stage
+# of the FAQ pipeline may use the given fraction of the time that remains
+# once it starts, the final response takes whatever is left.
+EMAIL_RESPONSE_BUDGET = 600
+STAGE_BUDGET_FRACTIONS = {
+    "extract_questions": 0.3,
+    "first_name": 0.2,
+    "answer": 0.7,
+    "response": 1.0,
+}
+
+# No single request to OpenAI may take longer than this many seconds, and
+# no request may wait longer than OPENAI_ADMISSION_TIMEOUT beyond that to be
+# admitted by the scheduler.
+OPENAI_REQUEST_TIMEOUT = 120
+OPENAI_ADMISSION_TIMEOUT = 120
+
+# Hedging sends a duplicate of any completion that has taken longer than
+# the given quantile of the model's recent latencies, and uses whichever
+# returns first. Both requests are billed.
+HEDGE_REQUESTS = False
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 200
+
+# The circuit breaker opens once at least CIRCUIT_MIN_CALLS requests within
+# the last CIRCUIT_WINDOW seconds have failed at CIRCUIT_ERROR_RATE or more.
+# It is probed after CIRCUIT_OPEN_SECONDS, doubling up to the maximum each
+# time the probe fails.
+CIRCUIT_WINDOW = 60
+CIRCUIT_MIN_CALLS = 10
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_OPEN_SECONDS = 30
+CIRCUIT_MAX_OPEN_SECONDS = 600
+
+# The backend used for the FAQ similarity search, either "numpy", "torch"
+# (which requires CUDA), or "auto" to use torch only where CUDA is present.
+SIMILARITY_BACKEND: Literal["auto", "numpy", "torch"] = "auto"
+
+# FAQs of at least ANN_MIN_SIZE questions are searched approximately, by
+# comparing each query only with the questions in the ANN_NPROBE clusters
+# nearest to it. A larger ANN_NPROBE gives a higher recall but is slower.
+# Set ANN_MIN_SIZE to None to always search exactly.
+ANN_MIN_SIZE: int | None = 20_000
+ANN_NPROBE = 16
+
+# A float16 or int8 copy of the FAQ embeddings halves or quarters the GPU
+# memory that the search reads through, with the top
+# EMBEDDING_RESCORE_CANDIDATES of each query rescored against the float32
+# embeddings. It is only searched with the torch similarity backend, as on
+# the CPU the exact search is faster.
+EMBEDDING_STORAGE: Literal["float32", "float16", "int8"] = "float32"
+EMBEDDING_RESCORE_CANDIDATES = 50
+
+# Embedding cache misses arriving within this many seconds of each other
+# are sent together, split to stay within the endpoint's request limits.
+EMBEDDING_BATCH_WINDOW = 0.01
+EMBEDDING_BATCH_MAX_INPUTS = 2048
+EMBEDDING_BATCH_MAX_TOKENS = 100_000
+
+# How often each process logs the requests queued for admission, while any
+# are queued.
+QUEUE_DEPTH_LOG_INTERVAL = 60
+
+
+class RateLimit(TypedDict):
+    requests_per_minute: int
+    tokens_per_minute: int
+    max_concurrency: int
+
+
+# The account's per-model quota. The scheduler admits requests at this
+# rate and temporarily lowers it whenever OpenAI responds with a 429.
+# The quota is shared between all of the processes on this machine.
+OPENAI_RATE_LIMITS: dict[str, RateLimit] = {
+    GPT_SOTA: {
+        "requests_per_minute": 200,
+        "tokens_per_minute": 40_000,
+        "max_concurrency": 16,
+    },
+    GPT_TURBO_SMALL_CONTEXT: {
+        "requests_per_minute": 3_500,
+        "tokens_per_minute": 90_000,
+        "max_concurrency": 32,
+    },
+    GPT_TURBO_LARGE_CONTEXT: {
+        "requests_per_minute": 3_500,
+        "tokens_per_minute": 180_000,
+        "max_concurrency": 32,
+    },
+    EMBEDDING_MODEL: {
+        "requests_per_minute": 3_000,
+        "tokens_per_minute": 1_000_000,
+        "max_concurrency": 32,
+    },
+}
+
+# Either "sqlite" (a single indexed file) or "directory" (the legacy layout
+# of one JSON file per request hash).
+COMPLETION_CACHE_BACKEND = "sqlite"
+
+# Byte budget for the in-process LRU tier that sits in front of the
+# completion cache store. Each API worker holds its own copy.
+MEMORY_CACHE_BYTES = 128 * 1024 * 1024
+
+# Cache records are written behind the request that produced them. When
+# this many are waiting to be written new writes wait for the queue.
+CACHE_WRITE_QUEUE_SIZE = 1000
+CACHE_WRITE_BATCH_SIZE = 100
+
+# Telemetry records are buffered in memory and appended to the log in a
+# worker thread, at most this many seconds after they were recorded.
+TELEMETRY_FLUSH_INTERVAL = 1.0
+
+# The completion cache store is pruned back under this size, least
+# recently accessed records first. Namespaces with a time to live (in
+# seconds) also have records older than that removed.
+COMPLETION_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+COMPLETION_CACHE_TTLS: dict[str, float | None] = {
+    "completion": None,
+    "embedding": None,
+    "legacy": None,
+}
+
+# The shared HTTP connection pool used for OpenAI, Postal and all other
+# outbound requests. Connections are kept alive between requests so that
+# bursts do not each pay for a new TLS handshake.
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 50
+HTTP_KEEPALIVE_TIMEOUT = 60
+HTTP_DNS_CACHE_TTL = 300
+HTTP_CONNECT_TIMEOUT = 10
+# Long completions can take minutes, so only the connect and the overall
+# request are bounded.
+HTTP_TOTAL_TIMEOUT = 600
+# How often each process logs the state of its connection pool, while it
+# is being used.
+HTTP_POOL_STATS_LOG_INTERVAL = 60
 
 SUPERVISION_SUBJECT_FLAG = "[SUPERVISION TASK]"
 
@@ -47,10 +224,28 @@ class FaqData(TypedDict):
     items: list[QAndAItem]
 
 
+# The parsed FAQ, along with the modification time and size of the file it
+# was parsed from.
+_faq_data_cache: tuple[tuple[int, int], FaqData] | None = None
+
+
 async def load_faq_data():
+    """The FAQ, parsed again only once faqs.toml has changed. The same
+    object is shared between callers, so it is not to be modified."""
+
+    global _faq_data_cache  # pylint: disable = global-statement
+
+    stat = SYNCED_FAQS_STORE.stat()
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    if _faq_data_cache is not None and _faq_data_cache[0] == version:
+        return _faq_data_cache[1]
+
     async with aiofiles.open(SYNCED_FAQS_STORE, encoding="utf8") as f:
         data = cast(FaqData, tomllib.loads(await f.read()))
 
+    _faq_data_cache = (version, data)
+
     return data
 
 
@@ -12,19 +12,140 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import collections
+import logging
 import pprint
+from typing import TypedDict
 
 import aiohttp
 
+from assistance._config import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_POOL_STATS_LOG_INTERVAL,
+    HTTP_TOTAL_TIMEOUT,
+)
+
 session: aiohttp.ClientSession
 
 pp = pprint.PrettyPrinter(indent=2)
 
+connection_counts: collections.Counter[str] = collections.Counter()
+
+
+class PoolStats(TypedDict):
+    limit: int
+    limit_per_host: int
+    in_use: int
+    in_use_per_host: dict[str, int]
+    idle: int
+    connections_created: int
+    connections_reused: int
+    requests: int
+
 
 def open_session():
     global session  # pylint: disable = global-statement
-    session = aiohttp.ClientSession()
+
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT
+    )
+
+    session = aiohttp.ClientSession(
+        connector=connector, timeout=timeout, trace_configs=[_get_trace_config()]
+    )
+
+
+def get_session():
+    """The shared session, opened on first use for entry points that did
+    not open it themselves."""
+
+    if not _is_open():
+        open_session()
+
+    return session
 
 
 async def close_session():
+    if not _is_open():
+        return
+
+    logging.info("HTTP connection pool on close: %s", get_pool_stats())
+
     await session.close()
+
+
+def get_pool_stats() -> PoolStats:
+    # pylint: disable = protected-access
+    connector = session.connector
+    assert isinstance(connector, aiohttp.TCPConnector)
+
+    in_use_per_host = {
+        f"{key.host}:{key.port}": len(connections)
+        for key, connections in connector._acquired_per_host.items()
+        if connections
+    }
+
+    return {
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "in_use": len(connector._acquired),
+        "in_use_per_host": in_use_per_host,
+        "idle": sum(len(connections) for connections in connector._conns.values()),
+        "connections_created": connection_counts["created"],
+        "connections_reused": connection_counts["reused"],
+        "requests": connection_counts["requests"],
+    }
+
+
+async def log_pool_stats(interval: float = HTTP_POOL_STATS_LOG_INTERVAL):
+    last_requests = 0
+
+    while True:
+        await asyncio.sleep(interval)
+
+        if not _is_open():
+            continue
+
+        stats = get_pool_stats()
+
+        if stats["in_use"] or stats["requests"] != last_requests:
+            logging.info("HTTP connection pool: %s", stats)
+
+        last_requests = stats["requests"]
+
+
+def _is_open():
+    try:
+        return not session.closed
+    except NameError:
+        return False
+
+
+def _get_trace_config():
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(*_):
+        connection_counts["requests"] += 1
+
+    async def on_connection_create_end(*_):
+        connection_counts["created"] += 1
+
+    async def on_connection_reuseconn(*_):
+        connection_counts["reused"] += 1
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+    return trace_config
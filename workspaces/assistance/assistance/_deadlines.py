@@ -0,0 +1,88 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import contextvars
+import time
+
+from assistance._config import STAGE_BUDGET_FRACTIONS
+
+# The time.monotonic() by which the work within the current context is to
+# be finished, or None when it is unbounded.
+deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextlib.contextmanager
+def budget(seconds: float):
+    """Bound the OpenAI requests made within this context, including those
+    from tasks created within it, to finish within the given seconds. An
+    enclosing budget that ends sooner still applies."""
+
+    new_deadline = time.monotonic() + seconds
+
+    current_deadline = deadline.get()
+    if current_deadline is not None:
+        new_deadline = min(new_deadline, current_deadline)
+
+    token = deadline.set(new_deadline)
+
+    try:
+        yield
+    finally:
+        deadline.reset(token)
+
+
+@contextlib.contextmanager
+def stage_budget(stage: str):
+    """Give the stage its configured fraction of the time that remains."""
+
+    time_remaining = get_remaining()
+    fraction = STAGE_BUDGET_FRACTIONS.get(stage)
+
+    if time_remaining is None or fraction is None:
+        yield
+        return
+
+    with budget(max(0.0, time_remaining) * fraction):
+        yield
+
+
+def get_remaining() -> float | None:
+    current_deadline = deadline.get()
+
+    if current_deadline is None:
+        return None
+
+    return current_deadline - time.monotonic()
+
+
+def get_timeout(limit: float):
+    """The timeout for a single request, at most the given limit, raising
+    DeadlineExceeded once there is no time left at all."""
+
+    time_remaining = get_remaining()
+
+    if time_remaining is None:
+        return limit
+
+    if time_remaining <= 0:
+        raise DeadlineExceeded("The deadline for this request has passed")
+
+    return min(limit, time_remaining)
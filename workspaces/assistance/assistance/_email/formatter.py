@@ -15,6 +15,7 @@
 
 import base64
 import json
+import logging
 from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -22,7 +23,7 @@ from email.mime.text import MIMEText
 import marko
 from mailparser_reply import EmailReplyParser
 
-from assistance import _ctx
+from assistance import _ctx, _postal
 from assistance._config import POSTAL_RAW_API_URL, SUPERVISION_SUBJECT_FLAG
 from assistance._keys import get_postal_api_key
 from assistance._paths import SYNCED_JIMS_REPO
@@ -89,7 +90,11 @@ async def handle_reply_formatter(email: Email):
         "data": b64_message,
     }
 
-    postal_response = await _ctx.session.post(
+    if _postal.dry_run:
+        logging.info(f"Dry run, the reply to {user_email_address} was not sent")
+        return None
+
+    postal_response = await _ctx.get_session().post(
         url=POSTAL_RAW_API_URL,
         headers=headers,
         data=json.dumps(postal_data),
@@ -12,8 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import fcntl
 import json
 import logging
+import os
+import pathlib
 import random
 import traceback
 from typing import Literal, cast
@@ -21,11 +25,16 @@ from typing import Literal, cast
 import html2text
 
 from assistance import _ctx
+from assistance._circuit import CircuitOpen
 from assistance._config import ROOT_DOMAIN
 from assistance._email.formatter import handle_reply_formatter
 from assistance._faq.response import write_and_send_email_response
 from assistance._logging import log_info
-from assistance._paths import NEW_EMAILS_PIPELINE, get_emails_path
+from assistance._paths import (
+    NEW_EMAILS_PIPELINE,
+    PARKED_EMAILS_PIPELINE,
+    get_emails_path,
+)
 from assistance._postal import send_email
 from assistance._types import Email, RawEmail
 from assistance._utilities import get_cleaned_email
@@ -42,6 +51,12 @@ async def handle_new_email(
         pipeline_path = get_new_email_pipeline_path(hash_digest)
         pipeline_path.unlink()
 
+    except CircuitOpen:
+        # OpenAI is currently failing. The pipeline file is left in place,
+        # and the email is handled again once the circuit closes.
+        logging.warning(f"OpenAI circuit breaker is open. Parking {hash_digest}.")
+        park_email(hash_digest)
+
     except Exception:  # pylint: disable=broad-except
         exception_string = traceback.format_exc()
 
@@ -98,7 +113,72 @@ async def rerun(hash_digest: str | None = None):
         await _single_rerun(hash_digest)
 
 
-async def _single_rerun(hash_digest: str):
+def park_email(hash_digest: str):
+    PARKED_EMAILS_PIPELINE.mkdir(parents=True, exist_ok=True)
+    PARKED_EMAILS_PIPELINE.joinpath(hash_digest).touch()
+
+
+async def redrive_parked_emails():
+    """Handle each of the emails that were parked while the OpenAI circuit
+    breaker was open, oldest first.
+
+    The emails are handled one at a time so as not to flood an API that has
+    only just recovered. Each is claimed with a lock first, so that when
+    several API workers redrive at once every email is only handled once.
+    """
+
+    parked_paths = sorted(
+        PARKED_EMAILS_PIPELINE.glob("*"), key=lambda path: path.stat().st_mtime
+    )
+
+    if parked_paths:
+        logging.info(f"Redriving {len(parked_paths)} parked emails.")
+
+    for parked_path in parked_paths:
+        with _claim(parked_path) as claimed:
+            if not claimed:
+                continue
+
+            # Removed before handling, as a failure to handle it again
+            # parks it again under a new file.
+            parked_path.unlink()
+
+            # A failure is reported by the error email for that email alone,
+            # so the rest of those parked are still redriven.
+            try:
+                await _single_rerun(parked_path.name, send_email_on_error=True)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(f"Failed to redrive {parked_path.name}.")
+
+
+@contextlib.contextmanager
+def _claim(path: pathlib.Path):
+    try:
+        file_descriptor = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        yield False
+        return
+
+    try:
+        try:
+            fcntl.lockf(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+
+        # Another worker may have claimed, handled and removed this file in
+        # between it being listed and locked here.
+        try:
+            claimed = os.stat(path).st_ino == os.fstat(file_descriptor).st_ino
+        except FileNotFoundError:
+            claimed = False
+
+        yield claimed
+    finally:
+        os.close(file_descriptor)
+
+
+async def _single_rerun(hash_digest: str, send_email_on_error=False):
     emails_path = get_emails_path(hash_digest)
 
     try:
@@ -114,7 +194,9 @@ async def _single_rerun(hash_digest: str):
         logging.error(f"Error decoding JSON: {contents}")
         raise
 
-    await handle_new_email(hash_digest, raw_email, send_email_on_error=False)
+    await handle_new_email(
+        hash_digest, raw_email, send_email_on_error=send_email_on_error
+    )
 
 
 def get_json_representation_of_raw_email(raw_email: RawEmail):
@@ -276,6 +358,6 @@ async def _post_gmail_forwarding_verification(verification_token):
     forwarding_verification_post_url = f"{VERIFICATION_TOKEN_BASE}{verification_token}"
     logging.info(forwarding_verification_post_url)
 
-    post_response = await _ctx.session.post(url=forwarding_verification_post_url)
+    post_response = await _ctx.get_session().post(url=forwarding_verification_post_url)
 
     logging.info(await post_response.read())
@@ -12,29 +12,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
 import collections
 
-import torch
+import numpy as np
 from asyncache import cached
 from cachetools import LRUCache
 from cachetools.keys import hashkey
 
-from assistance._openai import get_embedding
+from assistance import _ivf, _quantise
+from assistance._config import ANN_NPROBE, EMBEDDING_RESCORE_CANDIDATES
+from assistance._faq_index import get_faq_index
+from assistance._openai import get_embeddings
+from assistance._similarity import get_backend, top_k_embeddings
 
 
 async def get_top_questions_and_answers(openai_api_key, faq_data, queries, k=3):
+    responses_by_group = await get_top_questions_and_answers_by_group(
+        openai_api_key, faq_data, [queries], k=k
+    )
+
+    return responses_by_group[0]
+
+
+async def get_top_questions_and_answers_by_group(
+    openai_api_key, faq_data, query_groups: list[list[str]], k=3
+):
+    """As get_top_questions_and_answers for each group of queries, with the
+    queries of every group embedded and searched together in one pass."""
+
+    all_queries = [query for queries in query_groups for query in queries]
     all_most_relevant_results = await _get_top_questions_and_answers(
-        openai_api_key, faq_data, queries, k=k
+        openai_api_key, faq_data, all_queries, k=k
     )
 
+    responses_by_group = []
+    start = 0
+
+    for queries in query_groups:
+        end = start + len(queries)
+        responses_by_group.append(
+            _get_responses_with_score(all_most_relevant_results[start:end])
+        )
+        start = end
+
+    return responses_by_group
+
+
+def _get_responses_with_score(all_most_relevant_results):
     collected_q_and_a_strings_with_score = collections.defaultdict(list)
 
     for most_relevant_results in all_most_relevant_results:
-        for item in most_relevant_results:
+        for item, score in most_relevant_results:
             q_and_a_string = f"Question: {item['question'].strip()}\nAnswer: {item['answer'].strip()}"
 
-            collected_q_and_a_strings_with_score[q_and_a_string].append(item["score"])
+            collected_q_and_a_strings_with_score[q_and_a_string].append(score)
 
     strings_and_scores = []
     for q_and_a_string, scores in collected_q_and_a_strings_with_score.items():
@@ -51,64 +82,57 @@ async def get_top_questions_and_answers(openai_api_key, faq_data, queries, k=3):
 
 
 async def _get_top_questions_and_answers(openai_api_key, faq_data, queries, k=3):
+    if not queries:
+        return []
+
     queries = tuple(queries)
-    queries_embedding = await _get_cuda_embeddings(
+    queries_embedding = await _get_query_embeddings(
         queries, openai_api_key=openai_api_key
     )
 
-    all_questions: tuple[str, ...] = tuple(
-        [item["question"] for item in faq_data["items"]]
-    )
-    embeddings = await _get_cuda_embeddings(
-        all_questions, openai_api_key=openai_api_key
-    )
-    all_queries_indices, all_queries_scores = top_k_embeddings(
-        queries_embedding, embeddings, k
-    )
+    faq_index = await get_faq_index(faq_data, api_key=openai_api_key)
+
+    if faq_index["ivf"] is not None:
+        all_queries_indices, all_queries_scores = _ivf.search(
+            faq_index["ivf"], queries_embedding, faq_index["embeddings"], k, ANN_NPROBE
+        )
+    elif faq_index["quantised"] is not None and get_backend() == "torch":
+        all_queries_indices, all_queries_scores = _quantise.search(
+            faq_index["quantised"],
+            queries_embedding,
+            faq_index["embeddings"],
+            k,
+            EMBEDDING_RESCORE_CANDIDATES,
+            embeddings_key=faq_index["key"],
+            backend="torch",
+        )
+    else:
+        all_queries_indices, all_queries_scores = top_k_embeddings(
+            queries_embedding,
+            faq_index["embeddings"],
+            k,
+            embeddings_key=faq_index["key"],
+        )
 
     all_most_relevant_results = []
 
+    # The scores are kept alongside rather than set upon the shared FAQ
+    # items, as the same item is scored differently for each query.
     for indices, scores in zip(all_queries_indices, all_queries_scores):
-        most_relevant_results = [faq_data["items"][i] for i in indices]
-        for item, score in zip(most_relevant_results, scores):
-            item["score"] = score
-
-        all_most_relevant_results.append(most_relevant_results)
+        all_most_relevant_results.append(
+            [(faq_data["items"][i], score) for i, score in zip(indices, scores)]
+        )
 
     return all_most_relevant_results
 
 
-def top_k_embeddings(queries, embeddings, k):
-    k = torch.tensor(k, device="cuda")
-    cosine_similarity, index = _top_k_embeddings(queries, embeddings, k)
-
-    index = index.tolist()
-    cosine_similarity = cosine_similarity.tolist()
-
-    return index, cosine_similarity
-
-
-@torch.jit.script  # type: ignore
-def _top_k_embeddings(queries, embeddings, k):
-    transpose_queries = queries.T
-    embeddings_norm = torch.linalg.norm(embeddings, dim=1, keepdim=True)
-    query_norm = torch.linalg.norm(transpose_queries, dim=0, keepdim=True)
-
-    cosine_similarity = (
-        (embeddings @ transpose_queries) / (embeddings_norm @ query_norm)
-    ).T
-
-    return torch.topk(cosine_similarity, k)
-
-
 @cached(
     cache=LRUCache(maxsize=32),
     key=lambda blocks, openai_api_key: hashkey(blocks),
 )
-async def _get_cuda_embeddings(
+async def _get_query_embeddings(
     blocks: tuple[str, ...], openai_api_key: str
-) -> torch.Tensor:
-    embeddings = await asyncio.gather(
-        *[get_embedding(block=block, api_key=openai_api_key) for block in blocks]
-    )
-    return torch.tensor(embeddings, device="cuda")
+) -> np.ndarray:
+    embeddings = await get_embeddings(list(blocks), api_key=openai_api_key)
+
+    return np.array(embeddings, dtype=np.float32)
@@ -0,0 +1,388 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the OpenAI API, for running and load testing the
+FAQ pipeline without network access.
+
+Completions are deterministic for a given prompt, and are valid responses
+to each of the prompts within assistance. Embeddings are hashed bags of
+words, so that texts sharing words are still near one another.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+from typing import TypedDict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from assistance._config import MODEL_CONTEXT_SIZES
+from assistance._tokens import count_tokens
+
+EMBEDDING_DIMENSIONS = 1536
+FIRST_NAMES = ["Thandi", "Sipho", "Lerato", "Pieter", "Naledi", "Johan"]
+
+
+class FakeSettings(TypedDict):
+    # Seconds added to every request, varied by up to the jitter fraction.
+    latency: float
+    jitter: float
+    # The fraction of requests that respond with a 429, and the fraction of
+    # completions that respond as if the context length was exceeded.
+    rate_limit_rate: float
+    context_error_rate: float
+    seed: int
+
+
+DEFAULT_SETTINGS: FakeSettings = {
+    "latency": 0.5,
+    "jitter": 0.5,
+    "rate_limit_rate": 0,
+    "context_error_rate": 0,
+    "seed": 42,
+}
+
+
+def create_app(settings: FakeSettings = DEFAULT_SETTINGS):
+    app = FastAPI()
+
+    # Failures are injected from a seeded generator, so that a run with the
+    # same requests in the same order fails in the same places.
+    failures = random.Random(settings["seed"])
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body["model"]
+        prompt = "\n\n".join(message["content"] for message in body["messages"])
+
+        await _wait(settings, failures)
+
+        if failures.random() < settings["rate_limit_rate"]:
+            return _rate_limit_error(model)
+
+        prompt_tokens = count_tokens(prompt, model)
+        requested_tokens = prompt_tokens + body.get("max_tokens", 0)
+        context_size = MODEL_CONTEXT_SIZES.get(model, 4096)
+
+        if (
+            requested_tokens > context_size
+            or failures.random() < settings["context_error_rate"]
+        ):
+            return _context_length_error(context_size, requested_tokens)
+
+        content = get_completion_content(prompt)
+        completion_tokens = count_tokens(content, model)
+        message = {"role": "assistant", "content": content}
+
+        if "functions" in body:
+            message = _as_function_call(body["functions"][0], content)
+
+        return {
+            "id": f"chatcmpl-{_get_digest(prompt)[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "function_call" if "functions" in body else "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        model = body["model"]
+
+        inputs = body["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        await _wait(settings, failures)
+
+        if failures.random() < settings["rate_limit_rate"]:
+            return _rate_limit_error(model)
+
+        prompt_tokens = sum(count_tokens(text, model) for text in inputs)
+
+        return {
+            "object": "list",
+            "data": [
+                {"object": "embedding", "index": i, "embedding": get_embedding(text)}
+                for i, text in enumerate(inputs)
+            ],
+            "model": model,
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        }
+
+    return app
+
+
+def main(settings: FakeSettings = DEFAULT_SETTINGS, port: int = 8100):
+    uvicorn.run(create_app(settings), port=port, log_level="warning")
+
+
+def get_completion_content(prompt: str) -> str:
+    """A response to the prompt in the format that it asks for, chosen by
+    the prompt's first heading."""
+
+    heading_match = re.search(r"^# .*$", prompt, flags=re.MULTILINE)
+    heading = heading_match.group(0) if heading_match else ""
+    rng = random.Random(_get_digest(prompt))
+
+    if heading.startswith("# Extraction of Questions"):
+        return _extract_questions(prompt)
+
+    if heading.startswith("# Overview") and "sub-question" in prompt:
+        return _sub_questions(prompt)
+
+    if heading.startswith("# Overview"):
+        return _batched_questions(prompt)
+
+    if heading.startswith("# Get Correspondent"):
+        return rng.choice(FIRST_NAMES)
+
+    if heading.startswith("# Answering a prospective student's question"):
+        return _answer(prompt)
+
+    if heading.startswith("# Select best answer"):
+        return _rank(prompt, rng)
+
+    if heading.startswith("# Write an email introduction and conclusion"):
+        return _email_response(prompt)
+
+    if "summar" in heading.lower():
+        return "The student asked about the program and was given answers."
+
+    return "OK"
+
+
+def get_embedding(text: str) -> list[float]:
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+        index = int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS
+        sign = 1 if digest[4] % 2 else -1
+
+        vector[index] += sign
+
+    norm = math.sqrt(sum(value**2 for value in vector))
+    if norm == 0:
+        vector[0] = norm = 1.0
+
+    return [value / norm for value in vector]
+
+
+def _extract_questions(prompt: str):
+    email_address_match = re.search(r"email address of (\S+?)\.\s", prompt)
+    email_address = email_address_match.group(1) if email_address_match else ""
+
+    transcript = _get_section(prompt, "The email transcript")
+    questions = re.findall(r"[^.?!\n]+\?", transcript)[:3]
+
+    return json.dumps(
+        [
+            {
+                "think step by step for question and its context": "",
+                "question": question.strip(),
+                "context": question.strip(),
+                "think step by step for extracted answer": "",
+                "extracted answer": "",
+                "think step by step for verification questions": "",
+                "has the user's question been answered?": False,
+                "was this question asked after the given answer?": False,
+                f"was this question originally asked by {email_address}?": True,
+                "was this question originally asked by pathways@jims.international?": False,
+            }
+            for question in questions
+        ],
+        indent=4,
+    )
+
+
+def _sub_questions(prompt: str):
+    question = _get_section(prompt, "The current question")
+
+    return json.dumps(
+        [
+            {"think step by step": "", "question": question},
+            {"think step by step": "", "question": f"What is required for: {question}"},
+        ],
+        indent=4,
+    )
+
+
+def _batched_questions(prompt: str):
+    try:
+        questions = json.loads(_get_section(prompt, "The list of questions"))
+    except json.JSONDecodeError:
+        questions = []
+
+    return json.dumps(
+        [
+            {
+                "id": item["id"],
+                "think step by step": "",
+                "questions that should be asked before this one": [],
+            }
+            for item in questions
+        ],
+        indent=4,
+    )
+
+
+def _answer(prompt: str):
+    previous_responses = _get_section(
+        prompt, "Previous responses to OTHER prospective students"
+    )
+    answers = re.findall(r"^Answer: (.+)$", previous_responses, flags=re.MULTILINE)
+
+    if not answers:
+        return ""
+
+    return answers[0]
+
+
+def _rank(prompt: str, rng: random.Random):
+    try:
+        answers = json.loads(
+            _get_section(prompt, "Answers to THIS applicant's question to choose from")
+        )
+    except json.JSONDecodeError:
+        answers = [{"id": 0}]
+
+    return json.dumps(
+        {
+            "think step by step for id": "",
+            "id of the best answer": rng.choice(answers)["id"],
+            "think step by step for the four validation checks": "",
+            "does the selected answer completely answer the user's question?": True,
+            "does the selected answer get its information from the FAQ responses?": True,
+            "does the selected answer answer the question in a way that is consistent with the FAQ responses?": True,
+            "does the selected answer suggest following up the question with someone else?": False,
+        },
+        indent=4,
+    )
+
+
+def _email_response(prompt: str):
+    question_and_answers = _get_section(
+        prompt, "The questions and their answers that you have been provided."
+    )
+
+    return (
+        "Thank you for getting in touch about the program.\n\n---\n\n"
+        f"{question_and_answers}\n\n---\n\n"
+        "Kind regards,\nAlex Carpenter"
+    )
+
+
+def _as_function_call(function: dict, content: str):
+    """Respond through the function instead, wrapping the JSON the same
+    way as the function's parameters wrap any schema that is not an
+    object."""
+
+    try:
+        arguments = json.loads(content)
+    except json.JSONDecodeError:
+        # Passed through as is, as the real API can also call a function
+        # with invalid arguments.
+        arguments_json = content
+    else:
+        properties = function["parameters"].get("properties", {})
+
+        if not isinstance(arguments, dict) and len(properties) == 1:
+            arguments = {next(iter(properties)): arguments}
+
+        arguments_json = json.dumps(arguments)
+
+    return {
+        "role": "assistant",
+        "content": None,
+        "function_call": {"name": function["name"], "arguments": arguments_json},
+    }
+
+
+def _get_section(prompt: str, title: str):
+    """The text under the given level two heading, up to the next one."""
+
+    match = re.search(
+        rf"^## {re.escape(title)}\n(.*?)(?=^## |\Z)",
+        prompt,
+        flags=re.MULTILINE | re.DOTALL,
+    )
+
+    if match is None:
+        return ""
+
+    return match.group(1).strip()
+
+
+def _get_digest(text: str):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+async def _wait(settings: FakeSettings, failures: random.Random):
+    jitter = settings["jitter"] * (2 * failures.random() - 1)
+
+    await asyncio.sleep(max(0.0, settings["latency"] * (1 + jitter)))
+
+
+def _rate_limit_error(model: str):
+    return _error(
+        429,
+        f"Rate limit reached for {model} in organization org-fake on requests per min.",
+        "requests",
+        None,
+    )
+
+
+def _context_length_error(context_size: int, requested_tokens: int):
+    return _error(
+        400,
+        f"This model's maximum context length is {context_size} tokens. However, "
+        f"you requested {requested_tokens} tokens. Please reduce the length of the "
+        "messages or completion.",
+        "invalid_request_error",
+        "context_length_exceeded",
+    )
+
+
+def _error(status_code: int, message: str, error_type: str, code: str | None):
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "error": {
+                "message": message,
+                "type": error_type,
+                "param": None,
+                "code": code,
+            }
+        },
+    )
@@ -13,18 +13,18 @@
 # limitations under the License.
 
 import asyncio
+import functools
 import json
 import random
 import textwrap
 
 from assistance._config import GPT_TURBO_SMALL_CONTEXT
-from assistance._embeddings import get_top_questions_and_answers
+from assistance._embeddings import get_top_questions_and_answers_by_group
 from assistance._keys import get_openai_api_key
 from assistance._logging import log_info
-from assistance._openai import (
-    get_completion_only,
-    get_completion_test_for_json_decoding,
-)
+from assistance._openai import get_completion_only, get_completion_with_schema
+from assistance._telemetry import stage
+from assistance._tokens import count_tokens, fit_items, get_largest_model
 
 from .extract_questions import QuestionAndContext
 from .sub_questions import get_sub_questions
@@ -155,27 +155,84 @@ RANK = textwrap.dedent(
     """
 ).strip()
 
+RANK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "think step by step for id": {"type": "string"},
+        "id of the best answer": {"type": "integer"},
+        "think step by step for the four validation checks": {"type": "string"},
+        "does the selected answer completely answer the user's question?": {
+            "type": "boolean"
+        },
+        "does the selected answer get its information from the FAQ responses?": {
+            "type": "boolean"
+        },
+        "does the selected answer answer the question in a way that is consistent with the FAQ responses?": {
+            "type": "boolean"
+        },
+        "does the selected answer suggest following up the question with someone else?": {
+            "type": "boolean"
+        },
+    },
+    "required": [
+        "id of the best answer",
+        "does the selected answer completely answer the user's question?",
+        "does the selected answer get its information from the FAQ responses?",
+        "does the selected answer answer the question in a way that is consistent with the FAQ responses?",
+        "does the selected answer suggest following up the question with someone else?",
+    ],
+}
+
 MAXIMUM_FAQS = 15
 SEED = 42
 
 
-async def write_answer(
+async def write_answers(
     scope: str,
     faq_data,
-    question_and_context: QuestionAndContext,
+    questions_and_contexts: list[QuestionAndContext],
 ):
-    question = question_and_context["question"]
-    context = question_and_context["context"]
-
-    questions = await get_sub_questions(scope=scope, question=question, context=context)
+    """Answer each of the questions within an email, retrieving the FAQ
+    responses for all of their sub-questions in a single pass."""
+
+    with stage("sub_questions"):
+        sub_questions_by_question = await asyncio.gather(
+            *[
+                get_sub_questions(
+                    scope=scope,
+                    question=question_and_context["question"],
+                    context=question_and_context["context"],
+                )
+                for question_and_context in questions_and_contexts
+            ]
+        )
 
     # Don't need to batch the questions for this use case
     # questions_by_batch = await get_questions_by_batch(scope=scope, questions=questions)
 
-    faq_responses = await get_top_questions_and_answers(
-        openai_api_key=OPEN_AI_API_KEY, faq_data=faq_data, queries=questions
+    with stage("retrieval"):
+        faq_responses_by_question = await get_top_questions_and_answers_by_group(
+            openai_api_key=OPEN_AI_API_KEY,
+            faq_data=faq_data,
+            query_groups=sub_questions_by_question,
+        )
+
+    return await asyncio.gather(
+        *[
+            _write_answer(scope, question_and_context, faq_responses)
+            for question_and_context, faq_responses in zip(
+                questions_and_contexts, faq_responses_by_question
+            )
+        ]
     )
 
+
+async def _write_answer(
+    scope: str, question_and_context: QuestionAndContext, faq_responses: list[str]
+):
+    question = question_and_context["question"]
+    context = question_and_context["context"]
+
     faq_responses = faq_responses[0:MAXIMUM_FAQS]
 
     sorted_faq_responses = faq_responses.copy()
@@ -197,7 +254,8 @@ async def write_answer(
         )
         deterministic_random.shuffle(faq_responses)
 
-    question_responses = await asyncio.gather(*coroutines)
+    with stage("answer"):
+        question_responses = await asyncio.gather(*coroutines)
 
     log_info(scope, json.dumps(question_responses, indent=2))
 
@@ -208,17 +266,18 @@ async def write_answer(
     for i, response in enumerate(question_responses):
         question_responses_with_id.append({"id": i, "answer": response})
 
-    response = await _get_completion_with_faq_prune_fallback(
-        scope=scope,
-        prompt=RANK.format(
-            question=question,
-            context=context,
-            faq_responses="{faq_responses}",
-            answers=json.dumps(question_responses_with_id, indent=2),
-        ),
-        faq_responses=sorted_faq_responses,
-        check_json=True,
-    )
+    with stage("rank"):
+        response = await _get_completion_with_faq_prune_fallback(
+            scope=scope,
+            prompt=RANK.format(
+                question=question,
+                context=context,
+                faq_responses="{faq_responses}",
+                answers=json.dumps(question_responses_with_id, indent=2),
+            ),
+            faq_responses=sorted_faq_responses,
+            schema=RANK_SCHEMA,
+        )
 
     response_data = json.loads(response)
     best_answer_id = response_data["id of the best answer"]
@@ -247,13 +306,32 @@ async def write_answer(
 
 
 async def _get_completion_with_faq_prune_fallback(
-    scope: str, prompt: str, faq_responses: list[str], check_json=False
+    scope: str, prompt: str, faq_responses: list[str], schema: dict | None = None
 ):
-    if check_json:
-        completion_function = get_completion_test_for_json_decoding
+    if schema is not None:
+        completion_function = functools.partial(get_completion_with_schema, schema)
     else:
         completion_function = get_completion_only
 
+    model = get_largest_model(MODEL_KWARGS["engine"])
+
+    # The function definition that carries a schema also counts towards the
+    # prompt tokens.
+    reserved_tokens = MODEL_KWARGS["max_tokens"]
+    if schema is not None:
+        reserved_tokens += count_tokens(json.dumps(schema), model)
+
+    faq_responses = fit_items(
+        prompt=prompt,
+        placeholder="{faq_responses}",
+        items=faq_responses,
+        separator="\n\n",
+        model=model,
+        max_tokens=reserved_tokens,
+    )
+
+    # The tokeniser budget above should make this fallback unnecessary, it
+    # remains in case the budget is ever underestimated.
     while True:
         try:
             return await completion_function(
@@ -18,7 +18,7 @@ import textwrap
 from assistance._config import GPT_TURBO_SMALL_CONTEXT
 from assistance._keys import get_openai_api_key
 from assistance._logging import log_info
-from assistance._openai import get_completion_test_for_json_decoding
+from assistance._openai import get_completion_with_schema
 
 OPEN_AI_API_KEY = get_openai_api_key()
 
@@ -76,13 +76,34 @@ PROMPT = textwrap.dedent(
     """
 ).strip()
 
+SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "id": {"type": "integer"},
+            "think step by step": {"type": "string"},
+            "questions that should be asked before this one": {
+                "type": "array",
+                "items": {"type": "integer"},
+            },
+        },
+        "required": [
+            "id",
+            "think step by step",
+            "questions that should be asked before this one",
+        ],
+    },
+}
+
 
 async def get_questions_by_batch(scope: str, questions: list[str]) -> list[str]:
     questions_with_id = []
     for i, question in enumerate(questions):
         questions_with_id.append({"id": i, "question": question})
 
-    response = await get_completion_test_for_json_decoding(
+    response = await get_completion_with_schema(
+        SCHEMA,
         scope=scope,
         prompt=PROMPT.format(questions=json.dumps(questions_with_id, indent=4)),
         api_key=OPEN_AI_API_KEY,
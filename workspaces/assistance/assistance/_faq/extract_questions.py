@@ -135,6 +135,36 @@ SUMMARY_INSTRUCTIONS = textwrap.dedent(
 ).strip()
 
 
+def get_schema(email_address: str):
+    question_properties = {
+        "think step by step for question and its context": {"type": "string"},
+        "question": {"type": "string"},
+        "context": {"type": "string"},
+        "think step by step for extracted answer": {"type": "string"},
+        "extracted answer": {"type": "string"},
+        "think step by step for verification questions": {"type": "string"},
+        "has the user's question been answered?": {"type": "boolean"},
+        "was this question asked after the given answer?": {"type": "boolean"},
+        f"was this question originally asked by {email_address}?": {"type": "boolean"},
+        "was this question originally asked by pathways@jims.international?": {
+            "type": "boolean"
+        },
+    }
+
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": question_properties,
+            "required": [
+                key
+                for key in question_properties
+                if not key.startswith("think step by step")
+            ],
+        },
+    }
+
+
 class QuestionAndContext(TypedDict):
     question: str
     context: str
@@ -151,7 +181,7 @@ async def extract_questions(email: Email, reply_to: str) -> list[QuestionAndCont
 
     response, _ = await completion_on_thread_with_summary_fallback(
         scope=scope,
-        test_json=True,
+        schema=get_schema(reply_to),
         prompt=PROMPT.replace("{email_address}", reply_to),
         instructions="",
         email_thread=email_thread,
@@ -12,25 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import asyncio
 import textwrap
 
 from assistance._completion.summary import completion_on_thread_with_summary_fallback
 from assistance._config import (
+    EMAIL_RESPONSE_BUDGET,
     GPT_SOTA,
     ROOT_DOMAIN,
     SUPERVISION_SUBJECT_FLAG,
     load_faq_data,
 )
+from assistance._deadlines import budget, stage_budget
 from assistance._email.reply import create_reply
 from assistance._email.thread import get_email_thread
 from assistance._keys import get_openai_api_key
 from assistance._logging import log_info
 from assistance._postal import send_email
+from assistance._scheduler import priority
+from assistance._telemetry import scope as telemetry_scope
+from assistance._telemetry import stage
 from assistance._types import Email
 from assistance._utilities import get_cleaned_email
 
-from .answer import write_answer
+from .answer import write_answers
 from .correspondent import get_first_name
 from .extract_questions import extract_questions
 
@@ -139,6 +143,11 @@ PROMPT = textwrap.dedent(
 async def write_and_send_email_response(hash_digest: str, email: Email):
     scope = f'{hash_digest} - {email["user_email"]}'
 
+    with priority("interactive"), telemetry_scope(scope), budget(EMAIL_RESPONSE_BUDGET):
+        await _write_and_send_email_response(scope, email)
+
+
+async def _write_and_send_email_response(scope: str, email: Email):
     email_thread = get_email_thread(email=email)
 
     if email["subject"].startswith("Fwd: ") or email["subject"].startswith("FW: "):
@@ -222,7 +231,8 @@ async def write_and_send_email_response(hash_digest: str, email: Email):
 
 
 async def _handle_email_body(scope, email: Email, email_thread: list[str], reply_to):
-    questions_and_contexts = await extract_questions(email=email, reply_to=reply_to)
+    with stage("extract_questions"), stage_budget("extract_questions"):
+        questions_and_contexts = await extract_questions(email=email, reply_to=reply_to)
 
     questions_without_answers = [
         item
@@ -230,9 +240,10 @@ async def _handle_email_body(scope, email: Email, email_thread: list[str], reply
         if (item["answer_again"] or not item["answer"]) and item["question"]
     ]
 
-    first_name = await get_first_name(
-        scope=scope, email_thread=email_thread, their_email_address=reply_to
-    )
+    with stage("first_name"), stage_budget("first_name"):
+        first_name = await get_first_name(
+            scope=scope, email_thread=email_thread, their_email_address=reply_to
+        )
 
     response = await _handle_questions(
         scope, email, email_thread, first_name, questions_without_answers
@@ -249,18 +260,11 @@ async def _handle_questions(
 
     faq_data = await load_faq_data()
 
-    coroutines = []
-    for question_and_context in questions:
-        coroutines.append(
-            write_answer(
-                scope=scope,
-                faq_data=faq_data,
-                question_and_context=question_and_context,
-            )
+    with stage_budget("answer"):
+        answers = await write_answers(
+            scope=scope, faq_data=faq_data, questions_and_contexts=questions
         )
 
-    answers = await asyncio.gather(*coroutines)
-
     question_and_answers_string = ""
     for question_and_context, answer in zip(questions, answers):
         question_and_answers_string += (
@@ -281,12 +285,13 @@ async def _handle_questions(
         subject=prompt_subject,
     )
 
-    response, _ = await completion_on_thread_with_summary_fallback(
-        scope=scope,
-        prompt=prompt,
-        email_thread=email_thread,
-        api_key=OPEN_AI_API_KEY,
-        **MODEL_KWARGS,
-    )
+    with stage("response"), stage_budget("response"):
+        response, _ = await completion_on_thread_with_summary_fallback(
+            scope=scope,
+            prompt=prompt,
+            email_thread=email_thread,
+            api_key=OPEN_AI_API_KEY,
+            **MODEL_KWARGS,
+        )
 
     return response
@@ -19,7 +19,7 @@ import textwrap
 from assistance._config import GPT_TURBO_SMALL_CONTEXT
 from assistance._keys import get_openai_api_key
 from assistance._logging import log_info
-from assistance._openai import get_completion_test_for_json_decoding
+from assistance._openai import get_completion_with_schema
 
 OPEN_AI_API_KEY = get_openai_api_key()
 
@@ -113,6 +113,18 @@ PROMPT = textwrap.dedent(
     """
 ).strip()
 
+SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "think step by step": {"type": "string"},
+            "question": {"type": "string"},
+        },
+        "required": ["think step by step", "question"],
+    },
+}
+
 
 async def get_sub_questions(
     scope: str,
@@ -134,7 +146,8 @@ async def get_sub_questions(
 
     question_tree = [question]
 
-    response = await get_completion_test_for_json_decoding(
+    response = await get_completion_with_schema(
+        SCHEMA,
         scope=scope,
         prompt=PROMPT.format(
             question=question, original_question=original_question, context=context
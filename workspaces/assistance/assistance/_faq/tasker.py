@@ -20,10 +20,15 @@ import time
 import aiocron
 import tomlkit
 
+from assistance._config import load_faq_data
 from assistance._email.formatter import _get_reply_template
 from assistance._email.handler import initial_parsing
+from assistance._faq_index import build_faq_index
 from assistance._git import pull, push
+from assistance._keys import get_openai_api_key
 from assistance._paths import LOCAL_EMAIL_RECORD, SYNCED_JIMS_REPO, get_emails_path
+from assistance._scheduler import priority
+from assistance._telemetry import stage
 
 IGNORE_EMAIL_STRINGS = ["Ready to Launch"]
 
@@ -37,7 +42,12 @@ async def run_faq_update():
     logging.info("Running FAQ update")
 
     pull()
-    await _update_faq()
+
+    with priority("background"), stage("faq_update"):
+        await _update_faq()
+
+        # So that the API workers only need to map the index after a restart.
+        await build_faq_index(await load_faq_data(), api_key=get_openai_api_key())
 
     push("Push of data after FAQ update")
 
@@ -0,0 +1,313 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A precomputed matrix of the FAQ question embeddings, stored on disk so
+that every worker memory maps the one copy instead of reassembling it
+from the embedding cache one question at a time.
+
+Each index is named after a content hash of the FAQ questions, so an
+updated faqs.toml results in a new index rather than a stale one. Once
+the FAQ reaches ANN_MIN_SIZE questions an IVF index is stored alongside
+it for approximate search.
+
+The embeddings are stored at unit length, so that the cosine similarity
+is a single dot product. With EMBEDDING_STORAGE set to float16 or int8, a
+quantised copy is stored too, for a search on the GPU to shortlist from.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib
+from typing import TypedDict
+
+import numpy as np
+from cachetools import LRUCache
+
+from assistance import _ivf, _openai, _quantise
+from assistance._config import ANN_MIN_SIZE, EMBEDDING_MODEL, EMBEDDING_STORAGE, FaqData
+from assistance._paths import FAQ_INDEX, FAQ_INDEX_LOCK
+
+# Increment whenever the layout of the files changes.
+INDEX_VERSION = 2
+
+LOCK_POLL_INITIAL_INTERVAL = 0.05
+LOCK_POLL_MAX_INTERVAL = 1.0
+
+
+class FaqIndex(TypedDict):
+    key: str
+    questions: list[str]
+    # One unit length row per question, memory mapped read only.
+    embeddings: np.ndarray
+    ivf: _ivf.IvfIndex | None
+    quantised: _quantise.QuantisedEmbeddings | None
+
+
+_loaded: LRUCache[str, FaqIndex] = LRUCache(maxsize=4)
+_build_lock = asyncio.Lock()
+
+# The index key of each FAQ object, by its id. The object itself is held
+# too, both so that its id is not reused and to confirm the match.
+_index_keys: LRUCache[int, tuple[FaqData, str, str]] = LRUCache(maxsize=4)
+
+
+async def get_faq_index(faq_data: FaqData, api_key: str) -> FaqIndex:
+    """The index for these FAQ questions, building it first if no process
+    has done so yet."""
+
+    key = _get_cached_index_key(faq_data)
+
+    try:
+        return _loaded[key]
+    except KeyError:
+        pass
+
+    index = _load(key)
+
+    if index is None or _needs_ivf(index) or _needs_quantised(index):
+        async with _build_lock:
+            index = await _build_with_process_lock(
+                key, _get_questions(faq_data), api_key
+            )
+
+    _loaded[key] = index
+
+    return index
+
+
+async def build_faq_index(faq_data: FaqData, api_key: str):
+    """Build the index ahead of it being needed, and remove those for
+    previous versions of the FAQ."""
+
+    index = await get_faq_index(faq_data, api_key)
+
+    for path in [*FAQ_INDEX.glob("*.json"), *FAQ_INDEX.glob("*.npy")]:
+        if path.name.split(".")[0] != index["key"]:
+            path.unlink(missing_ok=True)
+
+
+def get_index_key(questions: list[str]):
+    hasher = hashlib.sha256()
+    hasher.update(
+        json.dumps(
+            {
+                "version": INDEX_VERSION,
+                "model": EMBEDDING_MODEL,
+                "api_base": _openai.api_base,
+                "questions": questions,
+            }
+        ).encode()
+    )
+
+    return hasher.hexdigest()
+
+
+def _get_cached_index_key(faq_data: FaqData):
+    """As get_index_key, hashing the questions only the first time that
+    this FAQ object is seen."""
+
+    cached = _index_keys.get(id(faq_data))
+
+    if cached is not None:
+        cached_faq_data, cached_api_base, key = cached
+
+        if cached_faq_data is faq_data and cached_api_base == _openai.api_base:
+            return key
+
+    key = get_index_key(_get_questions(faq_data))
+    _index_keys[id(faq_data)] = (faq_data, _openai.api_base, key)
+
+    return key
+
+
+def _get_questions(faq_data: FaqData):
+    return [item["question"] for item in faq_data["items"]]
+
+
+def _get_paths(key: str):
+    return FAQ_INDEX / f"{key}.json", FAQ_INDEX / f"{key}.npy"
+
+
+def _get_ivf_path(key: str, name: str):
+    return FAQ_INDEX / f"{key}.ivf-{name}.npy"
+
+
+def _needs_ivf(index: FaqIndex):
+    return (
+        ANN_MIN_SIZE is not None
+        and index["embeddings"].shape[0] >= ANN_MIN_SIZE
+        and index["ivf"] is None
+    )
+
+
+def _get_quantised_path(key: str, name: str):
+    return FAQ_INDEX / f"{key}.{EMBEDDING_STORAGE}-{name}.npy"
+
+
+def _needs_quantised(index: FaqIndex):
+    return EMBEDDING_STORAGE != "float32" and index["quantised"] is None
+
+
+def _load(key: str) -> FaqIndex | None:
+    questions_path, embeddings_path = _get_paths(key)
+
+    # The embeddings are written last, so their presence marks the index as
+    # complete.
+    try:
+        embeddings = np.load(embeddings_path, mmap_mode="r")
+
+        with open(questions_path, encoding="utf8") as f:
+            questions = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if len(questions) != embeddings.shape[0]:
+        logging.warning(f"Ignoring the inconsistent FAQ index {key}")
+        return None
+
+    return {
+        "key": key,
+        "questions": questions,
+        "embeddings": embeddings,
+        "ivf": _load_ivf(key),
+        "quantised": _load_quantised(key),
+    }
+
+
+def _load_ivf(key: str) -> _ivf.IvfIndex | None:
+    try:
+        return {
+            "centroids": np.load(_get_ivf_path(key, "centroids")),
+            "ids": np.load(_get_ivf_path(key, "ids"), mmap_mode="r"),
+            "offsets": np.load(_get_ivf_path(key, "offsets")),
+        }
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _load_quantised(key: str) -> _quantise.QuantisedEmbeddings | None:
+    if EMBEDDING_STORAGE == "float32":
+        return None
+
+    try:
+        vectors = np.load(_get_quantised_path(key, "vectors"), mmap_mode="r")
+
+        scales = None
+        if EMBEDDING_STORAGE == "int8":
+            scales = np.load(_get_quantised_path(key, "scales"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return {"storage": EMBEDDING_STORAGE, "vectors": vectors, "scales": scales}
+
+
+async def _build_with_process_lock(key: str, questions: list[str], api_key: str):
+    file_descriptor = await _acquire_process_lock()
+
+    try:
+        # Another process may have built it while this one waited.
+        index = _load(key)
+
+        if index is None:
+            logging.info(f"Building the FAQ index for {len(questions)} questions")
+
+            embeddings = np.array(
+                await _openai.get_embeddings(questions, api_key=api_key),
+                dtype=np.float32,
+            )
+            _write(key, questions, _normalise(embeddings))
+
+            index = _load(key)
+            assert index is not None
+
+        if _needs_ivf(index):
+            logging.info(f"Building the IVF index for {len(questions)} questions")
+
+            # Clustering takes seconds at this size, so it is kept off the
+            # event loop.
+            ivf = await asyncio.to_thread(_ivf.build, index["embeddings"])
+            for name, array in ivf.items():
+                _write_atomically(
+                    _get_ivf_path(key, name), lambda f, array=array: np.save(f, array)
+                )
+
+        if _needs_quantised(index):
+            quantised = _quantise.quantise(
+                np.asarray(index["embeddings"]), EMBEDDING_STORAGE
+            )
+            scales = quantised["scales"]
+            if scales is not None:
+                _write_atomically(
+                    _get_quantised_path(key, "scales"), lambda f: np.save(f, scales)
+                )
+
+            _write_atomically(
+                _get_quantised_path(key, "vectors"),
+                lambda f: np.save(f, quantised["vectors"]),
+            )
+    finally:
+        fcntl.lockf(file_descriptor, fcntl.LOCK_UN)
+        os.close(file_descriptor)
+
+    index = _load(key)
+    assert index is not None
+
+    return index
+
+
+def _write(key: str, questions: list[str], embeddings: np.ndarray):
+    FAQ_INDEX.mkdir(parents=True, exist_ok=True)
+    questions_path, embeddings_path = _get_paths(key)
+
+    # Written to temporary files and then renamed, so that no reader ever
+    # maps a partially written file.
+    _write_atomically(questions_path, lambda f: f.write(json.dumps(questions).encode()))
+    _write_atomically(embeddings_path, lambda f: np.save(f, embeddings))
+
+
+def _normalise(embeddings: np.ndarray):
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return embeddings / norms
+
+
+def _write_atomically(path: pathlib.Path, write):
+    temporary_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+    with open(temporary_path, "wb") as f:
+        write(f)
+
+    os.replace(temporary_path, path)
+
+
+async def _acquire_process_lock():
+    FAQ_INDEX_LOCK.parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor = os.open(FAQ_INDEX_LOCK, os.O_RDWR | os.O_CREAT)
+
+    interval = LOCK_POLL_INITIAL_INTERVAL
+
+    while True:
+        try:
+            fcntl.lockf(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return file_descriptor
+        except OSError:
+            pass
+
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, LOCK_POLL_MAX_INTERVAL)
@@ -0,0 +1,149 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An inverted file (IVF) index for approximate nearest neighbour search.
+
+The embeddings are clustered by spherical k-means, and each query is only
+compared with the embeddings within the clusters whose centroids are
+nearest to it. Searching more clusters (nprobe) raises the recall at the
+cost of latency.
+"""
+
+import math
+from typing import TypedDict
+
+import numpy as np
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 32
+ASSIGNMENT_CHUNK_SIZE = 8192
+SEED = 42
+
+
+class IvfIndex(TypedDict):
+    # One unit length row per list.
+    centroids: np.ndarray
+    # The embedding row ids grouped by list, where those of list i are
+    # ids[offsets[i]:offsets[i + 1]].
+    ids: np.ndarray
+    offsets: np.ndarray
+
+
+def build(embeddings: np.ndarray, number_of_lists: int | None = None) -> IvfIndex:
+    if number_of_lists is None:
+        number_of_lists = get_number_of_lists(embeddings.shape[0])
+
+    centroids = _train_centroids(embeddings, number_of_lists)
+    assignments = _assign(embeddings, centroids)
+
+    ids = np.argsort(assignments, kind="stable").astype(np.int64)
+    counts = np.bincount(assignments, minlength=number_of_lists)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    return {"centroids": centroids, "ids": ids, "offsets": offsets}
+
+
+def get_number_of_lists(size: int):
+    return max(1, round(4 * math.sqrt(size)))
+
+
+def search(
+    index: IvfIndex, queries: np.ndarray, embeddings: np.ndarray, k: int, nprobe: int
+):
+    """As _similarity.top_k_embeddings, for unit length embeddings, but only
+    comparing each query with the embeddings within its nprobe nearest
+    lists."""
+
+    nprobe = min(nprobe, index["centroids"].shape[0])
+    queries = _normalise(queries.astype(np.float32))
+
+    nearest_lists = np.argpartition(
+        -(queries @ index["centroids"].T), nprobe - 1, axis=1
+    )[:, :nprobe]
+
+    all_indices = []
+    all_similarities = []
+
+    for query, lists in zip(queries, nearest_lists):
+        # Sorted so that the rows are read from the memory map in order.
+        candidates = np.sort(
+            np.concatenate(
+                [
+                    index["ids"][index["offsets"][i] : index["offsets"][i + 1]]
+                    for i in lists
+                ]
+            )
+        )
+
+        similarities = embeddings[candidates] @ query
+
+        top = min(k, len(candidates))
+        best = np.argpartition(-similarities, top - 1)[:top] if top else []
+        best = sorted(best, key=lambda i: -similarities[i])
+
+        all_indices.append([int(candidates[i]) for i in best])
+        all_similarities.append([float(similarities[i]) for i in best])
+
+    return all_indices, all_similarities
+
+
+def _train_centroids(embeddings: np.ndarray, number_of_lists: int):
+    rng = np.random.default_rng(SEED)
+
+    size = embeddings.shape[0]
+    sample_size = min(size, number_of_lists * KMEANS_SAMPLES_PER_LIST)
+    sample = _normalise(
+        np.asarray(
+            embeddings[np.sort(rng.choice(size, sample_size, replace=False))],
+            dtype=np.float32,
+        )
+    )
+
+    centroids = sample[rng.choice(sample_size, number_of_lists, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _assign(sample, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+
+        # Any list left empty keeps its previous centroid.
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+
+        centroids = _normalise(sums)
+
+    return centroids
+
+
+def _assign(embeddings: np.ndarray, centroids: np.ndarray):
+    """The nearest centroid for each embedding, computed in chunks so that
+    the full similarity matrix is never held in memory."""
+
+    assignments = np.empty(embeddings.shape[0], dtype=np.int64)
+
+    for start in range(0, embeddings.shape[0], ASSIGNMENT_CHUNK_SIZE):
+        chunk = np.asarray(
+            embeddings[start : start + ASSIGNMENT_CHUNK_SIZE], dtype=np.float32
+        )
+        assignments[start : start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+    return assignments
+
+
+def _normalise(vectors: np.ndarray):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return vectors / norms
@@ -0,0 +1,153 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deterministic fixes for the ways in which a model's JSON response is
+most often malformed, so that these don't need another completion."""
+
+import ast
+import json
+import re
+from typing import Any, Callable
+
+CODE_FENCE = re.compile(r"```[\w-]*[ \t]*\n?(.*?)(?:```|\Z)", flags=re.DOTALL)
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+# Split on with a capturing group, so that the strings are every odd part.
+STRING = re.compile(r'("(?:[^"\\]|\\.)*")', flags=re.DOTALL)
+
+
+def loads_with_repairs(text: str) -> tuple[Any, list[str]]:
+    """Parse the JSON, applying each repair in turn until it parses.
+
+    Returns the data along with the names of the repairs that were
+    needed, which is empty when the text was valid to begin with. Raises
+    json.JSONDecodeError when no combination of repairs made it valid.
+    """
+
+    applied: list[str] = []
+
+    try:
+        return _parse_with_repairs(text, applied)
+    except json.JSONDecodeError as e:
+        original_error = e
+
+    for name, repair in REPAIRS:
+        repaired = repair(text)
+        if repaired == text:
+            continue
+
+        text = repaired
+        applied.append(name)
+
+        try:
+            return _parse_with_repairs(text, applied)
+        except json.JSONDecodeError:
+            continue
+
+    raise original_error
+
+
+def _strip_code_fence(text: str):
+    match = CODE_FENCE.search(text)
+    if match is None:
+        return text
+
+    return match.group(1)
+
+
+def _extract_outermost(text: str):
+    """Drop any prose before the first opening bracket and after its
+    final closing bracket, such as a leading "Here is the JSON:"."""
+
+    starts = [index for index in (text.find("{"), text.find("[")) if index != -1]
+    if not starts:
+        return text
+
+    start = min(starts)
+    closing = "}" if text[start] == "{" else "]"
+    end = text.rfind(closing)
+
+    if end <= start:
+        return text[start:]
+
+    return text[start : end + 1]
+
+
+def _replace_smart_quotes(text: str):
+    return text.translate(SMART_QUOTES)
+
+
+def _remove_trailing_commas(text: str):
+    return _replace_outside_strings(text, r",(\s*[}\]])", r"\1")
+
+
+REPAIRS: list[tuple[str, Callable[[str], str]]] = [
+    ("code_fence", _strip_code_fence),
+    ("surrounding_text", _extract_outermost),
+    ("smart_quotes", _replace_smart_quotes),
+    ("trailing_commas", _remove_trailing_commas),
+]
+
+
+def _parse_with_repairs(text: str, applied: list[str]):
+    data, tolerant = _parse_tolerantly(text)
+
+    if tolerant:
+        return data, [*applied, "tolerant_parser"]
+
+    return data, list(applied)
+
+
+def _parse_tolerantly(text: str) -> tuple[Any, bool]:
+    """As json.loads, but also accepting control characters within
+    strings and, failing that, Python literal syntax such as single
+    quoted strings.
+
+    Returns the data along with whether either of these was needed.
+    """
+
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as e:
+        error = e
+
+    try:
+        return json.loads(text, strict=False), True
+    except json.JSONDecodeError:
+        pass
+
+    try:
+        data = ast.literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise error from None
+
+    if not isinstance(data, (dict, list)):
+        raise error
+
+    # Round tripped so that only JSON types are returned.
+    try:
+        return json.loads(json.dumps(data)), True
+    except (TypeError, ValueError):
+        raise error from None
+
+
+def _replace_outside_strings(text: str, pattern: str, replacement: str):
+    """Apply the substitution to everything but the double quoted
+    strings."""
+
+    parts = STRING.split(text)
+
+    return "".join(
+        part if i % 2 else re.sub(pattern, replacement, part)
+        for i, part in enumerate(parts)
+    )
@@ -13,26 +13,86 @@
 # limitations under the License.
 
 import asyncio
+import collections
+import functools
 import json
 import logging
-import pathlib
+import time
+from typing import Awaitable, Callable
 
-import aiofiles
+import jsonschema
 import openai
+import openai.error
 from tenacity import (
+    RetryCallState,
     retry,
     retry_all,
     retry_if_exception_type,
     retry_if_not_exception_message,
+    retry_if_not_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
 
-from assistance import _ctx
+from assistance import (
+    _circuit,
+    _ctx,
+    _deadlines,
+    _json_repair,
+    _scheduler,
+    _telemetry,
+    _tokens,
+)
+from assistance._cache import codec as _cache_codec
+from assistance._cache import flight as _cache_flight
+from assistance._cache import keys as _cache_keys
+from assistance._cache import memory as _cache_memory
+from assistance._cache import stats as _cache_stats
+from assistance._cache import store as _cache_store
+from assistance._cache import writer as _cache_writer
+from assistance._config import (
+    EMBEDDING_BATCH_MAX_INPUTS,
+    EMBEDDING_BATCH_MAX_TOKENS,
+    EMBEDDING_BATCH_WINDOW,
+    EMBEDDING_MODEL,
+    HEDGE_MIN_SAMPLES,
+    HEDGE_QUANTILE,
+    HEDGE_REQUESTS,
+    HEDGE_WINDOW,
+    OPENAI_ADMISSION_TIMEOUT,
+    OPENAI_API_BASE,
+    OPENAI_REQUEST_TIMEOUT,
+)
+from assistance._keys import get_openai_api_key
 from assistance._logging import log_info
 
-from ._paths import get_completion_cache_path
-from ._utilities import get_hash_digest
+# Function parameters are required to be an object, so any other schema is
+# wrapped within this key and then unwrapped from the response.
+WRAPPED_SCHEMA_KEY = "items"
+SCHEMA_FUNCTION_NAME = "respond"
+SCHEMA_ATTEMPTS = 3
+
+
+# The API that all requests are sent to. This is always passed explicitly
+# so that the openai library's OPENAI_API_BASE environment variable cannot
+# redirect requests without the cache keys reflecting it.
+api_base = OPENAI_API_BASE
+
+
+def set_api_base(url: str):
+    """Send all subsequent requests to another OpenAI compatible API."""
+
+    global api_base  # pylint: disable = global-statement
+    api_base = url.rstrip("/")
+
+
+def _get_cache_api_base():
+    """Responses from any API other than OpenAI's are cached separately."""
+
+    if api_base == OPENAI_API_BASE:
+        return None
+
+    return api_base
 
 
 async def get_completion_test_for_json_decoding(**kwargs) -> str:
@@ -43,18 +103,109 @@ async def get_completion_test_for_json_decoding(**kwargs) -> str:
         response = await get_completion_only(**kwargs)
 
         try:
-            json.loads(response)
-            return response
-
+            data = _loads_with_repairs(kwargs["scope"], response)
         except json.decoder.JSONDecodeError:
             new_prompt = f"You have had {i} previous attempts at this task but you did not provide correct JSON.\n\nPlease ONLY provide valid JSON when undergoing the following task.\n\n{original_prompt}"
             kwargs["prompt"] = new_prompt
+        else:
+            return json.dumps(data, indent=2)
 
     assert isinstance(response, str)
 
     return response
 
 
+async def get_completion_with_schema(schema: dict, **kwargs) -> str:
+    """A completion constrained to the given JSON schema through function
+    calling, and then validated against it locally.
+
+    Returns the JSON as a string, as get_completion_test_for_json_decoding
+    does. Only when the response does not validate is the request sent
+    again, with the validation error included within the prompt.
+    """
+
+    original_prompt = kwargs["prompt"]
+    parameters = _get_function_parameters(schema)
+    validator = _get_validator(json.dumps(schema, sort_keys=True))
+
+    kwargs["functions"] = [
+        {
+            "name": SCHEMA_FUNCTION_NAME,
+            "description": "Provide the response in the required JSON format",
+            "parameters": parameters,
+        }
+    ]
+    kwargs["function_call"] = {"name": SCHEMA_FUNCTION_NAME}
+
+    error_message = ""
+
+    for _ in range(SCHEMA_ATTEMPTS):
+        response = await _completion_with_back_off(**kwargs)
+        message = response["choices"][0]["message"]  # type: ignore
+
+        function_call = message.get("function_call") or {}
+        arguments = function_call.get("arguments") or message.get("content") or ""
+
+        try:
+            data = _loads_with_repairs(kwargs["scope"], arguments)
+            if parameters is not schema:
+                data = data[WRAPPED_SCHEMA_KEY]
+
+            validator.validate(data)
+        except (ValueError, KeyError, TypeError, jsonschema.ValidationError) as e:
+            error_message = str(e).splitlines()[0]
+            log_info(kwargs["scope"], f"Invalid JSON response: {error_message}")
+
+            kwargs["prompt"] = (
+                "Your previous response to this task did not match the required "
+                f"JSON format. The error was: {error_message}\n\n{original_prompt}"
+            )
+
+            continue
+
+        stripped_response = json.dumps(data, indent=2)
+        log_info(kwargs["scope"], f"Response: {stripped_response}")
+
+        return stripped_response
+
+    raise ValueError(f"No valid JSON response was provided: {error_message}")
+
+
+def _loads_with_repairs(scope: str, response: str):
+    """Parse the JSON response, fixing it locally where it is only
+    trivially malformed rather than requesting a new completion."""
+
+    data, repairs = _json_repair.loads_with_repairs(response)
+
+    if repairs:
+        log_info(scope, f"Repaired JSON response with: {', '.join(repairs)}")
+
+    for repair in repairs:
+        _cache_stats.increment(f"{_cache_stats.JSON_REPAIR_PREFIX}{repair}")
+
+    return data
+
+
+def _get_function_parameters(schema: dict):
+    if schema.get("type") == "object":
+        return schema
+
+    return {
+        "type": "object",
+        "properties": {WRAPPED_SCHEMA_KEY: schema},
+        "required": [WRAPPED_SCHEMA_KEY],
+    }
+
+
+@functools.lru_cache(maxsize=64)
+def _get_validator(schema_json: str):
+    schema = json.loads(schema_json)
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+
+    return validator_class(schema)
+
+
 async def get_completion_only(**kwargs) -> str:
     response = await _completion_with_back_off(**kwargs)
 
@@ -65,53 +216,260 @@ async def get_completion_only(**kwargs) -> str:
     return stripped_response
 
 
-# Cache this with an LRU cache as well
 async def _completion_with_back_off(**kwargs):
+    start = time.monotonic()
+
     scope: str = kwargs["scope"]
     del kwargs["scope"]
 
     assert "scope" not in kwargs
 
+    routed_model = _tokens.route_model(
+        kwargs["engine"], _get_request_text(kwargs), kwargs["max_tokens"]
+    )
+    if routed_model != kwargs["engine"]:
+        log_info(scope, f"Routing from {kwargs['engine']} to {routed_model}")
+        kwargs["engine"] = routed_model
+
     kwargs_for_cache_hash = kwargs.copy()
     del kwargs_for_cache_hash["api_key"]
 
-    completion_request = json.dumps(kwargs_for_cache_hash, indent=2, sort_keys=True)
-    completion_request_hash = get_hash_digest(completion_request)
-    completion_cache_path = get_completion_cache_path(
-        completion_request_hash, create_parent=True
+    cache_api_base = _get_cache_api_base()
+    if cache_api_base is not None:
+        kwargs_for_cache_hash["api_base"] = cache_api_base
+
+    completion_request_hash = _cache_keys.completion_key(kwargs_for_cache_hash)
+
+    cached_response = await _load_cache(
+        completion_request_hash,
+        legacy_key=lambda: _cache_keys.legacy_completion_key(kwargs_for_cache_hash),
+    )
+    if cached_response is not None:
+        _telemetry.record_call(
+            "completion",
+            kwargs["engine"],
+            start,
+            "hit",
+            usage=cached_response.get("usage"),
+            call_scope=scope,
+        )
+
+        return cached_response
+
+    kwargs["prompt"] = _cache_keys.normalise_prompt(kwargs["prompt"])
+
+    attempts = _telemetry.Attempts()
+    response = await _cache_flight.run_once(
+        completion_request_hash,
+        create=lambda: _create_completion(
+            scope, completion_request_hash, kwargs, kwargs_for_cache_hash, attempts
+        ),
+        load=lambda: _load_cache(completion_request_hash),
     )
 
-    try:
-        async with aiofiles.open(completion_cache_path, "r") as f:
-            return json.loads(await f.read())
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+    _telemetry.record_call(
+        "completion",
+        kwargs["engine"],
+        start,
+        "miss" if attempts.count else "coalesced",
+        usage=response.get("usage"),
+        attempts=attempts.count,
+        call_scope=scope,
+    )
 
+    return response
+
+
+async def _create_completion(
+    scope: str,
+    completion_request_hash: str,
+    kwargs,
+    kwargs_for_cache_hash,
+    attempts: _telemetry.Attempts,
+):
     log_info(scope, _ctx.pp.pformat(kwargs_for_cache_hash))
 
-    response = await _run_completion(kwargs)
+    response = await _run_completion(kwargs, attempts)
 
     log_info(scope, f"Completion result: {response}")
 
-    asyncio.create_task(_store_cache(completion_cache_path, response))
+    await _store_cache(
+        completion_request_hash, _cache_codec.encode_completion(response)
+    )
 
     return response
 
 
+_wait_random_exponential = wait_random_exponential(min=1, max=60)
+
+
+def _wait_for_retry(retry_state: RetryCallState):
+    assert retry_state.outcome is not None
+
+    # The scheduler has already slowed admission down for this model, so
+    # there is no need to also sleep here.
+    if isinstance(retry_state.outcome.exception(), openai.error.RateLimitError):
+        return 0
+
+    wait = _wait_random_exponential(retry_state)
+
+    # Never sleep past the deadline, the next attempt then raises
+    # DeadlineExceeded straight away.
+    time_remaining = _deadlines.get_remaining()
+    if time_remaining is not None:
+        wait = max(0.0, min(wait, time_remaining))
+
+    return wait
+
+
 @retry(
     retry=retry_all(
         retry_if_not_exception_message("Model maximum reached"),
+        retry_if_not_exception_type(
+            (_deadlines.DeadlineExceeded, _circuit.CircuitOpen)
+        ),
         retry_if_exception_type(),
     ),
-    wait=wait_random_exponential(min=1, max=60),
+    wait=_wait_for_retry,
     stop=stop_after_attempt(12),
 )
-async def _run_completion(kwargs):
-    response = await _chat_completion_wrapper(**kwargs)
+async def _run_completion(kwargs, attempts: _telemetry.Attempts):
+    attempts.count += 1
+
+    tokens = _scheduler.estimate_tokens(
+        kwargs["engine"], _get_request_text(kwargs), kwargs["max_tokens"]
+    )
+
+    circuit.check()
+
+    # Bounds the wait for admission as well as the request itself. The
+    # request is given its own full timeout once admitted, so that a hanging
+    # API times out within the request, where the circuit breaker counts it,
+    # rather than here.
+    timeout = _deadlines.get_timeout(OPENAI_REQUEST_TIMEOUT + OPENAI_ADMISSION_TIMEOUT)
+
+    return await asyncio.wait_for(_complete_with_hedging(kwargs, tokens), timeout)
+
+
+def _get_request_text(kwargs):
+    """The text of the request that counts towards its prompt tokens,
+    including any function definitions."""
+
+    if "functions" not in kwargs:
+        return kwargs["prompt"]
+
+    return kwargs["prompt"] + json.dumps(kwargs["functions"])
+
+
+_completion_latencies: collections.defaultdict[
+    str, collections.deque[float]
+] = collections.defaultdict(lambda: collections.deque(maxlen=HEDGE_WINDOW))
+
+
+async def _complete_with_hedging(kwargs, tokens: int):
+    model = kwargs["engine"]
+    hedge_delay = _get_hedge_delay(model)
+
+    if hedge_delay is None:
+        return await _admitted_completion(kwargs, tokens)
+
+    sent = asyncio.Event()
+    requests = [asyncio.create_task(_admitted_completion(kwargs, tokens, sent))]
+
+    try:
+        # The delay counts from when the first request was sent rather than
+        # from when it was queued, so that a backlog does not cause hedges.
+        sent_waiter = asyncio.create_task(sent.wait())
+        await asyncio.wait(
+            [requests[0], sent_waiter], return_when=asyncio.FIRST_COMPLETED
+        )
+        sent_waiter.cancel()
+
+        done, _ = await asyncio.wait(requests, timeout=hedge_delay)
+
+        if not done:
+            logging.info(f"Hedging a {model} completion after {hedge_delay:.1f}s")
+            requests.append(asyncio.create_task(_admitted_completion(kwargs, tokens)))
+
+        return await _get_first_successful(requests)
+    finally:
+        for request in requests:
+            request.cancel()
+
+
+async def _admitted_completion(kwargs, tokens: int, sent: asyncio.Event | None = None):
+    async with _scheduler.admit(kwargs["engine"], tokens):
+        if sent is not None:
+            sent.set()
+
+        # Only what remains of the deadline once admitted is left for the
+        # request itself.
+        request_timeout = _deadlines.get_timeout(OPENAI_REQUEST_TIMEOUT)
+
+        start = time.monotonic()
+        response = await _record_outcome(
+            _chat_completion_wrapper(request_timeout=request_timeout, **kwargs),
+            request_timeout,
+        )
+
+    _completion_latencies[kwargs["engine"]].append(time.monotonic() - start)
 
     return response
 
 
+def _get_hedge_delay(model: str):
+    latencies = _completion_latencies[model]
+
+    if not HEDGE_REQUESTS or len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+
+    sorted_latencies = sorted(latencies)
+    index = min(len(sorted_latencies) - 1, int(HEDGE_QUANTILE * len(latencies)))
+
+    return sorted_latencies[index]
+
+
+async def _record_outcome(request: Awaitable, request_timeout: float):
+    """Record the outcome of a single request with the circuit breaker.
+
+    A request that timed out is only counted when it was given the full
+    request timeout, rather than whatever was left of an email's deadline.
+    """
+
+    try:
+        response = await request
+    except openai.error.Timeout as e:
+        if request_timeout >= OPENAI_REQUEST_TIMEOUT:
+            circuit.record(e)
+        raise
+    except Exception as e:
+        circuit.record(e)
+        raise
+
+    circuit.record(None)
+
+    return response
+
+
+async def _get_first_successful(tasks: list[asyncio.Task]):
+    pending = set(tasks)
+    error: BaseException | None = None
+
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            task_error = task.exception()
+            if task_error is None:
+                return task.result()
+
+            if error is None:
+                error = task_error
+
+    assert error is not None
+    raise error
+
+
 async def _chat_completion_wrapper(**kwargs):
     prompt = kwargs["prompt"]
     messages = [{"role": "user", "content": prompt}]
@@ -122,8 +480,10 @@ async def _chat_completion_wrapper(**kwargs):
     kwargs["model"] = kwargs["engine"]
     del kwargs["engine"]
 
+    _use_shared_session()
+
     try:
-        response = await openai.ChatCompletion.acreate(**kwargs)
+        response = await openai.ChatCompletion.acreate(api_base=api_base, **kwargs)
     except Exception as e:
         if "This model's maximum context length is" in str(e):
             raise ValueError("Model maximum reached") from e
@@ -133,9 +493,54 @@ async def _chat_completion_wrapper(**kwargs):
     return response
 
 
-async def _store_cache(completion_cache_path: pathlib.Path, response):
-    async with aiofiles.open(completion_cache_path, "w") as f:
-        await f.write(json.dumps(response, indent=2))
+def _use_shared_session():
+    # Without a session within this context the openai library opens, and
+    # then closes, a new session (and connection) for every request.
+    openai.aiosession.set(_ctx.get_session())
+
+
+async def _load_cache(hash_digest: str, legacy_key: Callable[[], str] | None = None):
+    # The in-memory tier holds the same compact records as the store, so
+    # that its byte budget reflects what is actually held.
+    cached = _cache_memory.get(hash_digest)
+
+    if cached is not None:
+        _cache_store.touch(hash_digest)
+    else:
+        cached = await _cache_store.load(hash_digest)
+
+        # Records from before the namespaced keys are looked up under their
+        # old key, and then copied across to the new one.
+        if cached is None and legacy_key is not None:
+            cached = await _cache_store.load(legacy_key())
+
+            if cached is not None:
+                await _cache_writer.enqueue(hash_digest, cached)
+
+        if cached is None:
+            _cache_stats.increment("disk_misses")
+            return None
+
+        _cache_stats.increment("disk_hits")
+        _cache_memory.put(hash_digest, cached, size=len(cached))
+
+    try:
+        return _cache_codec.decode(cached)
+    except ValueError:
+        _cache_stats.increment("corrupt_records")
+        return None
+
+
+async def _store_cache(hash_digest: str, encoded: bytes):
+    _cache_memory.put(hash_digest, encoded, size=len(encoded))
+
+    await _cache_writer.enqueue(hash_digest, encoded)
+
+
+async def get_embeddings(blocks: list[str], api_key) -> list[list[float]]:
+    return await asyncio.gather(
+        *[get_embedding(block=block, api_key=api_key) for block in blocks]
+    )
 
 
 async def get_embedding(block: str, api_key) -> list[float]:
@@ -144,27 +549,208 @@ async def get_embedding(block: str, api_key) -> list[float]:
 
 
 async def _get_embedding_with_cache(block: str, api_key):
-    block_hash = get_hash_digest(block)
-    cache_path = get_completion_cache_path(block_hash, create_parent=True)
+    start = time.monotonic()
+    cache_api_base = _get_cache_api_base()
+    block_hash = _cache_keys.embedding_key(block, EMBEDDING_MODEL, cache_api_base)
 
-    try:
-        async with aiofiles.open(cache_path, "r") as f:
-            return json.loads(await f.read())
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+    legacy_key = None
+    if cache_api_base is None:
+        legacy_key = functools.partial(_cache_keys.legacy_embedding_key, block)
 
-    logging.info("A new embedding: %s", block)
+    cached_result = await _load_cache(block_hash, legacy_key=legacy_key)
+    if cached_result is not None:
+        _telemetry.record_call("embedding", EMBEDDING_MODEL, start, "hit")
 
-    result = await _get_embedding(block, api_key)
+        return cached_result
 
-    asyncio.create_task(_store_cache(cache_path, result))
+    block = _cache_keys.normalise_embedding_text(block)
+
+    attempts = _telemetry.Attempts()
+    result = await _cache_flight.run_once(
+        block_hash,
+        create=lambda: _create_embedding(block, block_hash, api_key, attempts),
+        load=lambda: _load_cache(block_hash),
+    )
+
+    # The embeddings endpoint only reports usage for a whole batch, so each
+    # block's share is counted locally.
+    _telemetry.record_call(
+        "embedding",
+        EMBEDDING_MODEL,
+        start,
+        "miss" if attempts.count else "coalesced",
+        usage={"prompt_tokens": _tokens.count_tokens(block, EMBEDDING_MODEL)},
+        attempts=attempts.count,
+    )
 
     return result
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(12))
-async def _get_embedding(block: str, api_key):
-    result = await openai.Embedding.acreate(
-        input=block, api_key=api_key, model="text-embedding-ada-002"
-    )
+async def _create_embedding(
+    block: str, block_hash: str, api_key, attempts: _telemetry.Attempts
+):
+    logging.info("A new embedding: %s", block)
+
+    # Retries happen for the batch as a whole, and are not counted here.
+    attempts.count += 1
+
+    embedding = await _embedding_batcher.embed(block, api_key)
+    result = {
+        "object": "list",
+        "data": [{"object": "embedding", "index": 0, "embedding": embedding}],
+        "model": EMBEDDING_MODEL,
+    }
+
+    await _store_cache(block_hash, _cache_codec.encode_embedding(result))
+
     return result
+
+
+class _EmbeddingBatcher:
+    """Gathers the embedding cache misses from all concurrent coroutines
+    over a short window and sends them as list inputs, split so that each
+    request stays within the endpoint's input and token limits."""
+
+    def __init__(self):
+        self._pending: list[tuple[str, str, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._requests: set[asyncio.Task] = set()
+
+    async def embed(self, block: str, api_key: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((block, api_key, future))
+
+        if len(self._pending) >= EMBEDDING_BATCH_MAX_INPUTS:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(EMBEDDING_BATCH_WINDOW, self._flush)
+
+        # A batch is shared between callers with differing deadlines, so it
+        # is only bounded by the request timeout, and each caller stops
+        # waiting upon it at their own deadline.
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), _deadlines.get_remaining()
+            )
+        except TimeoutError as e:
+            raise _deadlines.DeadlineExceeded(
+                "The deadline for this embedding has passed"
+            ) from e
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+
+        for batch in _split_into_embedding_batches(pending):
+            task = asyncio.create_task(self._send(batch))
+            self._requests.add(task)
+            task.add_done_callback(self._requests.discard)
+
+    async def _send(self, batch: list[tuple[str, str, asyncio.Future]]):
+        blocks = [block for block, _, _ in batch]
+        api_key = batch[0][1]
+
+        try:
+            result = await _get_embeddings(blocks, api_key)
+        except openai.error.InvalidRequestError as e:
+            if len(batch) == 1:
+                _fail_embeddings(batch, e)
+                return
+
+            # Some input within the batch was rejected. Halving the batch
+            # until that input is alone leaves every other input embedded.
+            middle = len(batch) // 2
+            await asyncio.gather(self._send(batch[:middle]), self._send(batch[middle:]))
+
+            return
+        except Exception as e:  # pylint: disable = broad-except
+            _fail_embeddings(batch, e)
+            return
+
+        for item in result["data"]:
+            future = batch[item["index"]][2]
+            if not future.done():
+                future.set_result(item["embedding"])
+
+
+def _fail_embeddings(
+    batch: list[tuple[str, str, asyncio.Future]], error: BaseException
+):
+    for _, _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+
+
+def _split_into_embedding_batches(pending: list[tuple[str, str, asyncio.Future]]):
+    batches: dict[str, list[list[tuple[str, str, asyncio.Future]]]] = {}
+    batch_tokens: dict[str, int] = {}
+
+    for item in pending:
+        block, api_key, _ = item
+        tokens = _scheduler.estimate_tokens(EMBEDDING_MODEL, block)
+        batches_for_key = batches.setdefault(api_key, [[]])
+
+        if batches_for_key[-1] and (
+            len(batches_for_key[-1]) >= EMBEDDING_BATCH_MAX_INPUTS
+            or batch_tokens[api_key] + tokens > EMBEDDING_BATCH_MAX_TOKENS
+        ):
+            batches_for_key.append([])
+            batch_tokens[api_key] = 0
+
+        batches_for_key[-1].append(item)
+        batch_tokens[api_key] = batch_tokens.get(api_key, 0) + tokens
+
+    return [batch for batches_for_key in batches.values() for batch in batches_for_key]
+
+
+_embedding_batcher = _EmbeddingBatcher()
+
+
+@retry(
+    # A rejected input is rejected again however often it is sent.
+    retry=retry_if_not_exception_type(
+        (_circuit.CircuitOpen, openai.error.InvalidRequestError)
+    ),
+    wait=_wait_for_retry,
+    stop=stop_after_attempt(12),
+)
+async def _get_embeddings(blocks: list[str], api_key):
+    circuit.check()
+
+    tokens = sum(_scheduler.estimate_tokens(EMBEDDING_MODEL, block) for block in blocks)
+
+    async with _scheduler.admit(EMBEDDING_MODEL, tokens):
+        return await _record_outcome(
+            _request_embeddings(blocks, api_key), OPENAI_REQUEST_TIMEOUT
+        )
+
+
+async def _request_embeddings(blocks: list[str], api_key):
+    _use_shared_session()
+
+    try:
+        return await asyncio.wait_for(
+            openai.Embedding.acreate(
+                input=blocks,
+                api_key=api_key,
+                api_base=api_base,
+                model=EMBEDDING_MODEL,
+                request_timeout=OPENAI_REQUEST_TIMEOUT,
+            ),
+            OPENAI_REQUEST_TIMEOUT,
+        )
+    except TimeoutError as e:
+        raise openai.error.Timeout("Request timed out") from e
+
+
+async def _probe_api():
+    """A single minimal request, to check that the API has recovered."""
+
+    await _request_embeddings(["ping"], get_openai_api_key())
+
+
+circuit = _circuit.CircuitBreaker(probe=_probe_api)
@@ -43,11 +43,22 @@ LOCAL_RECORDS = STORE.joinpath("records")
 LOCAL_EMAIL_RECORD = LOCAL_RECORDS.joinpath("emails")
 
 COMPLETION_CACHE = LOCAL_RECORDS.joinpath("completion-cache")
+COMPLETION_CACHE_DB = LOCAL_RECORDS.joinpath("completion-cache.sqlite3")
+COMPLETION_CACHE_LOCK = LOCAL_RECORDS.joinpath("completion-cache.lock")
+
+TELEMETRY_LOG = LOCAL_RECORDS.joinpath("telemetry.jsonl")
+
+FAQ_INDEX = LOCAL_RECORDS.joinpath("faq-index")
+FAQ_INDEX_LOCK = LOCAL_RECORDS.joinpath("faq-index.lock")
+
+# The state of each model's shared token buckets.
+OPENAI_QUOTA_STATE = LOCAL_RECORDS.joinpath("openai-quota")
 
 PIPELINES = STORE.joinpath("pipelines")
 
 EMAIL_PIPELINES = PIPELINES.joinpath("emails")
 NEW_EMAILS_PIPELINE = EMAIL_PIPELINES.joinpath("new")
+PARKED_EMAILS_PIPELINE = EMAIL_PIPELINES.joinpath("parked")
 
 
 def get_emails_path(hash_digest: str, create_parent: bool = False):
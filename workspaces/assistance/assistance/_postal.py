@@ -21,6 +21,15 @@ from ._logging import log_info
 
 POSTAL_API_KEY = get_postal_api_key()
 
+# While set, emails are only logged, so that a rerun against a stand-in API
+# does not send its responses to anyone.
+dry_run = False
+
+
+def set_dry_run(enabled: bool = True):
+    global dry_run  # pylint: disable = global-statement
+    dry_run = enabled
+
 
 async def send_email(scope: str, postal_data):
     headers = {
@@ -33,7 +42,11 @@ async def send_email(scope: str, postal_data):
 
     log_info(scope, json.dumps(postal_data, indent=2))
 
-    postal_response = await _ctx.session.post(
+    if dry_run:
+        log_info(scope, "Dry run, the email was not sent")
+        return
+
+    postal_response = await _ctx.get_session().post(
         url=POSTAL_MESSAGE_API_URL,
         headers=headers,
         data=json.dumps(postal_data),
@@ -0,0 +1,187 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reduced precision copies of unit length embeddings.
+
+A search over a quantised copy only shortlists candidates, which are then
+rescored against the full precision embeddings. Only the shortlisted rows
+of the full precision memory map are then ever read.
+
+The shortlist is only faster than an exact search on the GPU, where the
+quantised copy is what is held in device memory. On the CPU each chunk is
+converted back to float32 first, so it is slower than an exact search and
+is kept only for comparison within the benchmark.
+"""
+
+# pylint: disable = import-outside-toplevel
+
+from typing import Callable, Literal, TypedDict
+
+import numpy as np
+from cachetools import LRUCache
+
+Storage = Literal["float32", "float16", "int8"]
+
+# Rows converted to a wider type at a time, bounding the memory used by a
+# search.
+CHUNK_SIZE = 8192
+
+
+class QuantisedEmbeddings(TypedDict):
+    storage: Storage
+    vectors: np.ndarray
+    # For int8, the factor by which each row was scaled.
+    scales: np.ndarray | None
+
+
+def quantise(embeddings: np.ndarray, storage: Storage) -> QuantisedEmbeddings:
+    if storage == "float16":
+        return {
+            "storage": storage,
+            "vectors": embeddings.astype(np.float16),
+            "scales": None,
+        }
+
+    if storage == "int8":
+        # Symmetric, per row, so that each row's largest component is ±127.
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+
+        vectors = np.round(embeddings / scales[:, None]).astype(np.int8)
+
+        return {
+            "storage": storage,
+            "vectors": vectors,
+            "scales": scales.astype(np.float32),
+        }
+
+    raise ValueError(f"Unsupported quantised storage: {storage}")
+
+
+# Device copies of the quantised vectors and scales, keyed by the FAQ
+# index that they were copied from.
+_device_quantised: LRUCache = LRUCache(maxsize=4)
+
+
+def search(
+    quantised: QuantisedEmbeddings,
+    queries: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    candidates: int,
+    embeddings_key: str | None = None,
+    backend: Literal["numpy", "torch"] = "numpy",
+):
+    """As _similarity.top_k_embeddings, for unit length embeddings, with
+    the top candidates of the quantised search rescored against the full
+    precision embeddings."""
+
+    vectors = quantised["vectors"]
+    candidates = min(max(k, candidates), vectors.shape[0])
+    k = min(k, candidates)
+
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(
+        np.float32
+    )
+    shortlist = SHORTLISTS[backend](quantised, queries, candidates, embeddings_key)
+
+    all_indices = []
+    all_similarities = []
+
+    for query, rows in zip(queries, shortlist):
+        # Sorted so that the rows are read from the memory map in order.
+        rows = np.sort(rows)
+        similarities = embeddings[rows] @ query
+
+        best = np.argsort(-similarities, kind="stable")[:k]
+
+        all_indices.append(rows[best].tolist())
+        all_similarities.append(similarities[best].tolist())
+
+    return all_indices, all_similarities
+
+
+def _numpy_shortlist(
+    quantised: QuantisedEmbeddings,
+    queries: np.ndarray,
+    candidates: int,
+    embeddings_key: str | None,
+) -> np.ndarray:
+    del embeddings_key
+
+    vectors = quantised["vectors"]
+    approximate = np.empty((queries.shape[0], vectors.shape[0]), dtype=np.float32)
+
+    for start in range(0, vectors.shape[0], CHUNK_SIZE):
+        chunk = np.asarray(vectors[start : start + CHUNK_SIZE], dtype=np.float32)
+        scores = queries @ chunk.T
+
+        if quantised["scales"] is not None:
+            scores *= quantised["scales"][start : start + CHUNK_SIZE]
+
+        approximate[:, start : start + len(chunk)] = scores
+
+    return np.argpartition(-approximate, candidates - 1, axis=1)[:, :candidates]
+
+
+def _torch_shortlist(
+    quantised: QuantisedEmbeddings,
+    queries: np.ndarray,
+    candidates: int,
+    embeddings_key: str | None,
+) -> np.ndarray:
+    import torch
+
+    device_quantised = None
+    if embeddings_key is not None:
+        device_quantised = _device_quantised.get(embeddings_key)
+
+    if device_quantised is None:
+        # Copied as stored, so that the device holds the reduced precision.
+        device_quantised = (
+            torch.tensor(np.asarray(quantised["vectors"]), device="cuda"),
+            None
+            if quantised["scales"] is None
+            else torch.tensor(quantised["scales"], device="cuda"),
+        )
+
+        if embeddings_key is not None:
+            _device_quantised[embeddings_key] = device_quantised
+
+    vectors, scales = device_quantised
+    device_queries = torch.tensor(queries, device="cuda").half()
+
+    if scales is None:
+        approximate = device_queries @ vectors.T
+    else:
+        # int8 matrix products are not generally available, so the vectors
+        # are widened to float16 a chunk at a time.
+        approximate = (
+            torch.cat(
+                [
+                    device_queries @ vectors[start : start + CHUNK_SIZE].half().T
+                    for start in range(0, vectors.shape[0], CHUNK_SIZE)
+                ],
+                dim=1,
+            )
+            * scales.half()
+        )
+
+    return torch.topk(approximate, candidates).indices.cpu().numpy()
+
+
+SHORTLISTS: dict[str, Callable[..., np.ndarray]] = {
+    "numpy": _numpy_shortlist,
+    "torch": _torch_shortlist,
+}
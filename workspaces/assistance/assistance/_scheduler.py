@@ -0,0 +1,335 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextlib
+import contextvars
+import fcntl
+import functools
+import heapq
+import itertools
+import logging
+import os
+import pathlib
+import struct
+import time
+from typing import Literal, TypedDict
+
+import openai.error
+
+from assistance._config import OPENAI_RATE_LIMITS, QUEUE_DEPTH_LOG_INTERVAL, RateLimit
+from assistance._paths import OPENAI_QUOTA_STATE
+from assistance._tokens import count_tokens
+
+# On a 429 the admitted rate is multiplied by this factor, and then
+# recovers additively with each successful request.
+RATE_LIMITED_BACK_OFF = 0.7
+SUCCESS_RECOVERY = 0.02
+MINIMUM_RATE_SCALE = 0.1
+
+# Background requests are only admitted while this fraction of each
+# bucket remains, leaving headroom for a burst of interactive requests.
+BACKGROUND_RESERVE = 0.25
+
+Lane = Literal["interactive", "background"]
+LANE_ORDER: dict[Lane, int] = {"interactive": 0, "background": 1}
+
+lane: contextvars.ContextVar[Lane] = contextvars.ContextVar(
+    "lane", default="interactive"
+)
+
+
+class QuotaState(TypedDict):
+    requests: float
+    tokens: float
+    # The time.time() at which the levels were last refilled.
+    last_update: float
+    rate_scale: float
+
+
+class SharedQuota:
+    """The RPM and TPM token buckets of a single model, shared between every
+    process (the API runs many gunicorn workers, alongside the tasker)
+    through a small state file.
+
+    Each access holds an fcntl lock on that file for only as long as it
+    takes to read and write the state, so it is taken directly on the loop.
+    """
+
+    _layout = struct.Struct("<dddd")
+
+    def __init__(self, path: pathlib.Path, rate_limit: RateLimit):
+        self.path = path
+        self.requests_capacity = float(rate_limit["requests_per_minute"])
+        self.tokens_capacity = float(rate_limit["tokens_per_minute"])
+        self._file_descriptor: int | None = None
+
+    def try_take(self, tokens: int, reserve: float = 0) -> float:
+        """Take a request and its tokens from the buckets if both have
+        them, returning 0. Otherwise nothing is taken, and the seconds
+        until they would both have them is returned."""
+
+        # A request larger than the bucket waits only for a full bucket.
+        tokens = min(tokens, self.tokens_capacity)
+
+        with self._state() as state:
+            wait = max(
+                _seconds_until(
+                    state["requests"], 1, self.requests_capacity, state, reserve
+                ),
+                _seconds_until(
+                    state["tokens"], tokens, self.tokens_capacity, state, reserve
+                ),
+            )
+
+            if wait <= 0:
+                state["requests"] -= 1
+                state["tokens"] -= tokens
+
+        return wait
+
+    def on_success(self):
+        with self._state() as state:
+            state["rate_scale"] = min(1.0, state["rate_scale"] + SUCCESS_RECOVERY)
+
+    def on_rate_limited(self):
+        with self._state() as state:
+            state["rate_scale"] = max(
+                MINIMUM_RATE_SCALE, state["rate_scale"] * RATE_LIMITED_BACK_OFF
+            )
+
+            # Whatever budget we thought we had evidently was not there.
+            state["requests"] = min(state["requests"], 0)
+            state["tokens"] = min(state["tokens"], 0)
+
+        return state["rate_scale"]
+
+    def get_rate_scale(self):
+        with self._state() as state:
+            return state["rate_scale"]
+
+    @contextlib.contextmanager
+    def _state(self):
+        file_descriptor = self._get_file_descriptor()
+        fcntl.lockf(file_descriptor, fcntl.LOCK_EX)
+
+        try:
+            now = time.time()
+            data = os.pread(file_descriptor, self._layout.size, 0)
+
+            if len(data) == self._layout.size:
+                requests, tokens, last_update, rate_scale = self._layout.unpack(data)
+            else:
+                requests, tokens, last_update, rate_scale = (
+                    self.requests_capacity,
+                    self.tokens_capacity,
+                    now,
+                    1.0,
+                )
+
+            # Clamped, as the clock may have been stepped backwards.
+            elapsed = max(0.0, now - last_update)
+
+            state: QuotaState = {
+                "requests": min(
+                    self.requests_capacity,
+                    requests + elapsed * self.requests_capacity / 60 * rate_scale,
+                ),
+                "tokens": min(
+                    self.tokens_capacity,
+                    tokens + elapsed * self.tokens_capacity / 60 * rate_scale,
+                ),
+                "last_update": now,
+                "rate_scale": rate_scale,
+            }
+
+            yield state
+
+            os.pwrite(
+                file_descriptor,
+                self._layout.pack(
+                    state["requests"],
+                    state["tokens"],
+                    state["last_update"],
+                    state["rate_scale"],
+                ),
+                0,
+            )
+        finally:
+            fcntl.lockf(file_descriptor, fcntl.LOCK_UN)
+
+    def _get_file_descriptor(self):
+        if self._file_descriptor is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file_descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT)
+
+        return self._file_descriptor
+
+
+def _seconds_until(
+    level: float, amount: float, capacity: float, state: QuotaState, reserve: float
+):
+    shortfall = amount + reserve * capacity - level
+
+    if shortfall <= 0:
+        return 0.0
+
+    return shortfall / (capacity / 60 * state["rate_scale"])
+
+
+class ModelScheduler:
+    """Admits requests to a single model within its RPM and TPM quota,
+    which is shared with every other process.
+
+    Interactive requests are always admitted ahead of background ones,
+    and background requests may not use the last BACKGROUND_RESERVE of
+    either bucket.
+    """
+
+    def __init__(self, model: str, rate_limit: RateLimit, quota: SharedQuota):
+        self.model = model
+
+        self._quota = quota
+        self._concurrency = asyncio.Semaphore(rate_limit["max_concurrency"])
+
+        # Requests waiting for admission, ordered by lane and then by arrival.
+        # Only the head of this queue may take from the buckets.
+        self._waiting: list[tuple[int, int]] = []
+        self._arrivals = itertools.count()
+        self._condition = asyncio.Condition()
+
+    @property
+    def rate_scale(self):
+        return self._quota.get_rate_scale()
+
+    @property
+    def queue_depth(self):
+        return len(self._waiting)
+
+    def get_queue_depth_by_lane(self):
+        depths = {name: 0 for name in LANE_ORDER}
+        lane_names = {order: name for name, order in LANE_ORDER.items()}
+
+        for order, _ in self._waiting:
+            depths[lane_names[order]] += 1
+
+        return depths
+
+    @contextlib.asynccontextmanager
+    async def admit(self, tokens: int):
+        await self._wait_for_capacity(tokens, lane.get())
+        await self._concurrency.acquire()
+
+        try:
+            yield
+        except openai.error.RateLimitError:
+            self._on_rate_limited()
+            raise
+        else:
+            self._quota.on_success()
+        finally:
+            self._concurrency.release()
+
+    async def _wait_for_capacity(self, tokens: int, request_lane: Lane):
+        entry = (LANE_ORDER[request_lane], next(self._arrivals))
+        reserve = BACKGROUND_RESERVE if request_lane == "background" else 0
+
+        async with self._condition:
+            heapq.heappush(self._waiting, entry)
+
+            # A new arrival may have overtaken the current head of the queue.
+            self._condition.notify_all()
+
+            try:
+                while True:
+                    timeout = None
+
+                    if self._waiting[0] == entry:
+                        # Other processes take from the same buckets, so
+                        # this is only the soonest that the head could be
+                        # admitted, and it is checked again then.
+                        timeout = self._quota.try_take(tokens, reserve)
+
+                        if timeout <= 0:
+                            break
+
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def _on_rate_limited(self):
+        rate_scale = self._quota.on_rate_limited()
+
+        logging.info(
+            f"Rate limited on {self.model}, admitting at {rate_scale:.0%} of quota"
+        )
+
+
+@functools.cache
+def get_scheduler(model: str) -> ModelScheduler:
+    rate_limit = OPENAI_RATE_LIMITS[model]
+
+    return ModelScheduler(
+        model, rate_limit, SharedQuota(OPENAI_QUOTA_STATE / model, rate_limit)
+    )
+
+
+def admit(model: str, tokens: int):
+    return get_scheduler(model).admit(tokens)
+
+
+@contextlib.contextmanager
+def priority(request_lane: Lane):
+    """Tag the OpenAI requests made within this context, including those
+    from tasks created within it, with the given lane."""
+
+    token = lane.set(request_lane)
+
+    try:
+        yield
+    finally:
+        lane.reset(token)
+
+
+def estimate_tokens(model: str, text: str, max_tokens: int = 0):
+    """The tokens that OpenAI counts against the per-minute quota for a
+    request, the prompt plus all of the completion tokens requested."""
+
+    return count_tokens(text, model) + max_tokens
+
+
+def get_queue_depths():
+    return {
+        model: get_scheduler(model).get_queue_depth_by_lane()
+        for model in OPENAI_RATE_LIMITS
+    }
+
+
+async def log_queue_depths(interval: float = QUEUE_DEPTH_LOG_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+
+        for model, depths in get_queue_depths().items():
+            if any(depths.values()):
+                scheduler = get_scheduler(model)
+                logging.info(
+                    f"Queued for {model}: {depths['interactive']} interactive, "
+                    f"{depths['background']} background, admitting at "
+                    f"{scheduler.rate_scale:.0%} of quota"
+                )
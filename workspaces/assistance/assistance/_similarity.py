@@ -0,0 +1,276 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The cosine similarity top k search behind FAQ retrieval.
+
+NumPy is used unless torch is installed along with a CUDA device, in
+which case the search runs on the GPU. Torch is only imported when it is
+selected, so that the API can run on nodes without it.
+"""
+
+# pylint: disable = import-outside-toplevel
+
+import functools
+import importlib.util
+import logging
+import time
+from typing import Callable, Literal, TypedDict
+
+import numpy as np
+from cachetools import LRUCache
+
+from assistance import _ivf, _quantise
+from assistance._config import (
+    ANN_NPROBE,
+    EMBEDDING_RESCORE_CANDIDATES,
+    SIMILARITY_BACKEND,
+)
+
+Backend = Literal["numpy", "torch"]
+TopK = tuple[list[list[int]], list[list[float]]]
+
+
+class BenchmarkResult(TypedDict):
+    # Either a backend, "ivf" for the approximate search, or the storage of
+    # a quantised search, suffixed by its backend when that is not numpy.
+    method: str
+    size: int
+    mean_latency: float
+    p95_latency: float
+    # The fraction of the exact top k that were found.
+    recall: float
+
+
+# Device copies of the FAQ embeddings, keyed by the FAQ index that they
+# were copied from.
+_device_embeddings: LRUCache = LRUCache(maxsize=4)
+
+
+def top_k_embeddings(
+    queries: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    embeddings_key: str | None = None,
+    backend: Backend | None = None,
+) -> TopK:
+    """The indices and cosine similarities of the k embeddings most similar
+    to each query, most similar first. The embeddings are required to be of
+    unit length, so that only the queries need normalising.
+
+    The embeddings_key names an unchanging embeddings matrix, allowing
+    backends to keep their own copy of it between calls.
+    """
+
+    if backend is None:
+        backend = get_backend()
+
+    k = min(k, embeddings.shape[0])
+
+    return BACKENDS[backend](queries, embeddings, k, embeddings_key)
+
+
+@functools.cache
+def get_backend() -> Backend:
+    if SIMILARITY_BACKEND != "auto":
+        return SIMILARITY_BACKEND
+
+    backend = get_available_backends()[-1]
+
+    logging.info(f"Using the {backend} similarity backend")
+
+    return backend
+
+
+def get_available_backends() -> list[Backend]:
+    """The backends that can run here, in order of preference from least
+    to most preferred."""
+
+    backends: list[Backend] = ["numpy"]
+
+    if importlib.util.find_spec("torch") is not None:
+        import torch
+
+        if torch.cuda.is_available():
+            backends.append("torch")
+
+    return backends
+
+
+def _numpy_top_k(
+    queries: np.ndarray, embeddings: np.ndarray, k: int, embeddings_key: str | None
+) -> TopK:
+    del embeddings_key
+
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    cosine_similarity = queries @ embeddings.T
+
+    # Only the k largest are sorted, rather than every similarity.
+    if k < cosine_similarity.shape[1]:
+        index = np.argpartition(-cosine_similarity, k - 1, axis=1)[:, :k]
+    else:
+        index = np.broadcast_to(
+            np.arange(cosine_similarity.shape[1]), cosine_similarity.shape
+        )
+
+    top_similarity = np.take_along_axis(cosine_similarity, index, axis=1)
+    order = np.argsort(-top_similarity, axis=1, kind="stable")
+
+    index = np.take_along_axis(index, order, axis=1)
+    top_similarity = np.take_along_axis(top_similarity, order, axis=1)
+
+    return index.tolist(), top_similarity.tolist()
+
+
+def _torch_top_k(
+    queries: np.ndarray, embeddings: np.ndarray, k: int, embeddings_key: str | None
+) -> TopK:
+    import torch
+
+    device_embeddings = None
+    if embeddings_key is not None:
+        device_embeddings = _device_embeddings.get(embeddings_key)
+
+    if device_embeddings is None:
+        device_embeddings = torch.tensor(np.asarray(embeddings), device="cuda")
+
+        if embeddings_key is not None:
+            _device_embeddings[embeddings_key] = device_embeddings
+
+    cosine_similarity, index = _get_torch_kernel()(
+        torch.tensor(queries, device="cuda"),
+        device_embeddings,
+        torch.tensor(k, device="cuda"),
+    )
+
+    return index.tolist(), cosine_similarity.tolist()
+
+
+@functools.cache
+def _get_torch_kernel():
+    import torch
+
+    def _top_k_embeddings(queries, embeddings, k):
+        query_norm = torch.linalg.norm(queries, dim=1, keepdim=True)
+        cosine_similarity = (queries / query_norm) @ embeddings.T
+
+        return torch.topk(cosine_similarity, k)
+
+    return torch.jit.script(_top_k_embeddings)
+
+
+BACKENDS: dict[Backend, Callable[..., TopK]] = {
+    "numpy": _numpy_top_k,
+    "torch": _torch_top_k,
+}
+
+
+def benchmark(
+    sizes: list[int],
+    number_of_queries: int = 5,
+    k: int = 3,
+    repeats: int = 50,
+    dimensions: int = 1536,
+    backends: list[Backend] | None = None,
+    nprobe: int = ANN_NPROBE,
+):
+    """The latency of a single search, exact, approximate and quantised, on
+    random clustered embeddings of each number of FAQ questions."""
+
+    if backends is None:
+        backends = get_available_backends()
+
+    rng = np.random.default_rng(42)
+    results: list[BenchmarkResult] = []
+
+    for size in sizes:
+        embeddings, queries = _get_benchmark_embeddings(
+            rng, size, number_of_queries, dimensions
+        )
+        key = f"benchmark-{size}"
+        exact_indices, _ = top_k_embeddings(queries, embeddings, k, key, "numpy")
+
+        ivf = _ivf.build(embeddings)
+        searches = {
+            backend: functools.partial(
+                top_k_embeddings, queries, embeddings, k, key, backend
+            )
+            for backend in backends
+        }
+        searches["ivf"] = functools.partial(
+            _ivf.search, ivf, queries, embeddings, k, nprobe
+        )
+
+        for storage in ["float16", "int8"]:
+            quantised = _quantise.quantise(embeddings, storage)
+
+            for backend in backends:
+                method = storage if backend == "numpy" else f"{storage}-{backend}"
+                searches[method] = functools.partial(
+                    _quantise.search,
+                    quantised,
+                    queries,
+                    embeddings,
+                    k,
+                    EMBEDDING_RESCORE_CANDIDATES,
+                    f"{key}-{storage}",
+                    backend,
+                )
+
+        for method, search in searches.items():
+            # The first call is not timed, as it includes any copy to the
+            # device and compilation of the kernel.
+            indices, _ = search()
+
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                search()
+                latencies.append(time.perf_counter() - start)
+
+            latencies.sort()
+            found = sum(
+                len(set(approximate) & set(exact))
+                for approximate, exact in zip(indices, exact_indices)
+            )
+
+            results.append(
+                {
+                    "method": method,
+                    "size": size,
+                    "mean_latency": sum(latencies) / len(latencies),
+                    "p95_latency": latencies[int(0.95 * (len(latencies) - 1))],
+                    "recall": found / sum(len(exact) for exact in exact_indices),
+                }
+            )
+
+    return results
+
+
+def _get_benchmark_embeddings(
+    rng: np.random.Generator, size: int, number_of_queries: int, dimensions: int
+):
+    """Embeddings scattered around topics, as the FAQ questions are, with
+    queries drawn near to some of them."""
+
+    topics = rng.standard_normal((max(1, size // 50), dimensions), dtype=np.float32)
+
+    embeddings = topics[rng.integers(len(topics), size=size)] + 0.5 * (
+        rng.standard_normal((size, dimensions), dtype=np.float32)
+    )
+    queries = embeddings[rng.integers(size, size=number_of_queries)] + 0.5 * (
+        rng.standard_normal((number_of_queries, dimensions), dtype=np.float32)
+    )
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    return embeddings, queries
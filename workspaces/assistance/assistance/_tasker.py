@@ -17,12 +17,13 @@
 import asyncio
 import logging
 
-from assistance import _ctx
+from assistance import _ctx, _telemetry
+from assistance._cache import writer as _cache_writer
 
 
 def main():
-    _ctx.open_session()
-
+    # The shared HTTP session is opened on first use, within the loop.
+    from assistance._cache import tasker as _cache_tasker
     from assistance._campaign import tasker as _campaign_tasker
     from assistance._faq import tasker as _faq_tasker
 
@@ -30,4 +31,9 @@ def main():
 
     logging.info("Starting tasker")
 
-    loop.run_forever()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(_cache_writer.flush())
+        loop.run_until_complete(_telemetry.flush())
+        loop.run_until_complete(_ctx.close_session())
@@ -0,0 +1,274 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import pathlib
+import time
+from typing import Literal, TypedDict
+
+from assistance._config import OPENAI_PRICES, TELEMETRY_FLUSH_INTERVAL
+from assistance._paths import TELEMETRY_LOG
+
+Kind = Literal["completion", "embedding"]
+
+# A "hit" was served from the cache, a "coalesced" call waited upon an
+# identical request that was already in flight, and a "miss" was sent to
+# OpenAI and billed.
+CacheOutcome = Literal["hit", "coalesced", "miss"]
+
+current_stage: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_stage", default="other"
+)
+current_scope: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+    "current_scope", default=None
+)
+
+
+class CallRecord(TypedDict):
+    time: float
+    scope: str | None
+    stage: str
+    kind: Kind
+    model: str
+    cache: CacheOutcome
+    attempts: int
+    latency: float
+    prompt_tokens: int
+    completion_tokens: int
+
+
+class StageSummary(TypedDict):
+    calls: int
+    misses: int
+    p50_latency: float
+    p95_latency: float
+    prompt_tokens: int
+    completion_tokens: int
+    cost: float
+
+
+class TelemetrySummary(TypedDict):
+    stages: dict[str, StageSummary]
+    scope_costs: dict[str, float]
+
+
+# The records not yet written to the log.
+_buffered: list[CallRecord] = []
+_flush_task: asyncio.Task | None = None
+
+
+class Attempts:
+    """Counts the attempts made at a retried request, which also records
+    whether this caller made the request at all."""
+
+    def __init__(self):
+        self.count = 0
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Attribute the OpenAI calls made within this context, including those
+    from tasks created within it, to the given pipeline stage."""
+
+    token = current_stage.set(name)
+
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+@contextlib.contextmanager
+def scope(name: str):
+    """Attribute the OpenAI calls made within this context to the given
+    scope, for those calls that are not given a scope directly."""
+
+    token = current_scope.set(name)
+
+    try:
+        yield
+    finally:
+        current_scope.reset(token)
+
+
+def record_call(
+    kind: Kind,
+    model: str,
+    start: float,
+    cache: CacheOutcome,
+    usage: dict | None = None,
+    attempts: int = 0,
+    call_scope: str | None = None,
+):
+    """Record a single call into the OpenAI layer, where start is the
+    time.monotonic() at which the call began.
+
+    Within an event loop the record is buffered, and written along with the
+    others recorded within TELEMETRY_FLUSH_INTERVAL, so that the loop never
+    waits on the file.
+    """
+
+    global _flush_task  # pylint: disable = global-statement
+
+    if usage is None:
+        usage = {}
+
+    if call_scope is None:
+        call_scope = current_scope.get()
+
+    record: CallRecord = {
+        "time": time.time(),
+        "scope": call_scope,
+        "stage": current_stage.get(),
+        "kind": kind,
+        "model": model,
+        "cache": cache,
+        "attempts": attempts,
+        "latency": time.monotonic() - start,
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0),
+    }
+
+    _buffered.append(record)
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write_records(_take_buffered())
+        return
+
+    if _flush_task is None or _flush_task.done():
+        _flush_task = loop.create_task(_flush_after(TELEMETRY_FLUSH_INTERVAL))
+
+
+async def flush():
+    """Write any buffered records to the telemetry log."""
+
+    records = _take_buffered()
+
+    if records:
+        await asyncio.to_thread(_write_records, records)
+
+
+async def _flush_after(delay: float):
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        # The loop is closing, so the records are written while it still can.
+        _write_records(_take_buffered())
+        raise
+
+    await flush()
+
+
+def _take_buffered():
+    records = _buffered.copy()
+    _buffered.clear()
+
+    return records
+
+
+def _write_records(records: list[CallRecord]):
+    if not records:
+        return
+
+    try:
+        TELEMETRY_LOG.parent.mkdir(parents=True, exist_ok=True)
+
+        with TELEMETRY_LOG.open("a") as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+    except OSError:
+        logging.warning("Unable to write to the telemetry log", exc_info=True)
+
+
+def load_records(path: pathlib.Path = TELEMETRY_LOG, since: float = 0):
+    records: list[CallRecord] = []
+
+    try:
+        with path.open() as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A partially written final line from an interrupted process.
+                    continue
+
+                if record["time"] >= since:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+
+    return records
+
+
+def get_cost(record: CallRecord):
+    """The estimated cost of the call in US dollars. Only cache misses are
+    billed."""
+
+    if record["cache"] != "miss":
+        return 0.0
+
+    try:
+        price = OPENAI_PRICES[record["model"]]
+    except KeyError:
+        return 0.0
+
+    return (
+        record["prompt_tokens"] * price["prompt"]
+        + record["completion_tokens"] * price["completion"]
+    ) / 1000
+
+
+def summarise(records: list[CallRecord]) -> TelemetrySummary:
+    records_by_stage: dict[str, list[CallRecord]] = {}
+    scope_costs: dict[str, float] = {}
+
+    for record in records:
+        records_by_stage.setdefault(record["stage"], []).append(record)
+
+        if record["scope"] is not None:
+            scope_costs[record["scope"]] = scope_costs.get(
+                record["scope"], 0.0
+            ) + get_cost(record)
+
+    stages: dict[str, StageSummary] = {}
+
+    for stage_name, stage_records in sorted(records_by_stage.items()):
+        latencies = sorted(record["latency"] for record in stage_records)
+        misses = [record for record in stage_records if record["cache"] == "miss"]
+
+        stages[stage_name] = {
+            "calls": len(stage_records),
+            "misses": len(misses),
+            "p50_latency": _percentile(latencies, 0.5),
+            "p95_latency": _percentile(latencies, 0.95),
+            "prompt_tokens": sum(record["prompt_tokens"] for record in misses),
+            "completion_tokens": sum(record["completion_tokens"] for record in misses),
+            "cost": sum(get_cost(record) for record in misses),
+        }
+
+    return {"stages": stages, "scope_costs": scope_costs}
+
+
+def _percentile(sorted_values: list[float], fraction: float):
+    if not sorted_values:
+        return 0.0
+
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+
+    return sorted_values[index]
@@ -0,0 +1,159 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import hashlib
+import logging
+
+import tiktoken
+from cachetools import LRUCache
+
+from assistance._config import MODEL_CONTEXT_SIZES, MODEL_ROUTES
+
+# Every chat request wraps the prompt within a single user message. This
+# covers that message's framing along with the priming of the reply.
+CHAT_MESSAGE_OVERHEAD = 7
+
+# Token counts of separately encoded pieces can differ slightly from the
+# count of the pieces joined together, so budgets keep this in reserve.
+SAFETY_MARGIN = 16
+
+
+# Used to approximate the count when tiktoken's encoding cannot be
+# downloaded. Fewer characters than the typical four per token, so that the
+# approximation errs towards overcounting.
+APPROXIMATE_CHARACTERS_PER_TOKEN = 3
+
+
+class _ApproximateEncoding:
+    """Splits text into fixed length runs of characters, for counting and
+    truncating without tiktoken's encoding files, such as when running
+    against the fake API offline."""
+
+    def encode(self, text: str, **_) -> list[str]:
+        size = APPROXIMATE_CHARACTERS_PER_TOKEN
+        return [text[i : i + size] for i in range(0, len(text), size)]
+
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+
+@functools.cache
+def _get_encoding(model: str):
+    # The encoding files are downloaded on first use, and then cached within
+    # TIKTOKEN_CACHE_DIR.
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except OSError as e:
+        logging.warning(
+            f"Approximating the {model} token counts, as its encoding could "
+            f"not be loaded: {e}"
+        )
+
+        return _ApproximateEncoding()
+
+
+# Keyed by a digest of the text, so that the cache does not keep every
+# counted prompt alive.
+_token_counts: LRUCache[tuple[bytes, str], int] = LRUCache(maxsize=4096)
+
+
+def count_tokens(text: str, model: str) -> int:
+    key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), model)
+
+    try:
+        return _token_counts[key]
+    except KeyError:
+        pass
+
+    tokens = len(_get_encoding(model).encode(text, disallowed_special=()))
+    _token_counts[key] = tokens
+
+    return tokens
+
+
+def count_prompt_tokens(prompt: str, model: str) -> int:
+    return count_tokens(prompt, model) + CHAT_MESSAGE_OVERHEAD
+
+
+def get_prompt_budget(model: str, max_tokens: int) -> int:
+    """The number of tokens a prompt may use while leaving room for
+    ``max_tokens`` of completion."""
+
+    return MODEL_CONTEXT_SIZES[model] - max_tokens - SAFETY_MARGIN
+
+
+def prompt_fits(prompt: str, model: str, max_tokens: int) -> bool:
+    return count_prompt_tokens(prompt, model) <= get_prompt_budget(model, max_tokens)
+
+
+def route_model(model: str, prompt: str, max_tokens: int) -> str:
+    """The smallest model within the requested model's route that fits the
+    prompt. If none of them do, the largest is returned."""
+
+    route = MODEL_ROUTES.get(model, [model])
+
+    for candidate in route:
+        if prompt_fits(prompt, candidate, max_tokens):
+            return candidate
+
+    return route[-1]
+
+
+def get_largest_model(model: str) -> str:
+    return MODEL_ROUTES.get(model, [model])[-1]
+
+
+def fit_items(
+    prompt: str,
+    placeholder: str,
+    items: list[str],
+    separator: str,
+    model: str,
+    max_tokens: int,
+) -> list[str]:
+    """The longest leading run of items that, when joined and substituted
+    for the placeholder, keeps the prompt within the model's budget."""
+
+    remaining = get_prompt_budget(model, max_tokens) - count_prompt_tokens(
+        prompt.replace(placeholder, ""), model
+    )
+    separator_tokens = count_tokens(separator, model)
+
+    fitted = []
+    for item in items:
+        item_tokens = count_tokens(item, model)
+        if fitted:
+            item_tokens += separator_tokens
+
+        if item_tokens > remaining:
+            break
+
+        fitted.append(item)
+        remaining -= item_tokens
+
+    return fitted
+
+
+def truncate_to_tokens(text: str, model: str, tokens: int) -> str:
+    encoding = _get_encoding(model)
+    encoded = encoding.encode(text, disallowed_special=())
+
+    if len(encoded) <= tokens:
+        return text
+
+    return encoding.decode(encoded[:tokens])
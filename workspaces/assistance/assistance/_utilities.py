@@ -17,28 +17,11 @@ import re
 import textwrap
 from urllib.parse import parse_qs, urlparse
 
-WORDS_PER_TOKEN = 0.75
-APPROXIMATE_ALLOWED_WORDS_IN_PROMPT = 4097 * WORDS_PER_TOKEN
-
 
 def items_to_list_string(items):
     return textwrap.indent("\n".join(items), "- ")
 
 
-# TODO: Use direct tokenisation rather than this approximation
-def get_approximate_allowed_remaining_words(prompt: str, max_tokens: int):
-    words_in_prompt = get_number_of_words(prompt)
-    num_words_used_by_tokens = max_tokens * WORDS_PER_TOKEN
-
-    return APPROXIMATE_ALLOWED_WORDS_IN_PROMPT - (
-        num_words_used_by_tokens + words_in_prompt
-    )
-
-
-def get_number_of_words(text: str):
-    return len(text.split(None))
-
-
 def get_cleaned_url(url: str):
     replaced_and = url.replace("\r\n", "").replace("\n", "").replace("&amp;", "&")
     parsed_url = urlparse(replaced_and)
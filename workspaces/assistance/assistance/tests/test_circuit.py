@@ -0,0 +1,65 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel, protected-access
+
+import asyncio
+
+import pytest
+
+
+def test_completion_timeouts_are_recorded_by_the_circuit_breaker(monkeypatch, tmp_path):
+    import openai
+    import openai.error
+    from tenacity import stop_after_attempt
+
+    from assistance import _openai, _scheduler, _telemetry
+    from assistance._config import GPT_TURBO_SMALL_CONTEXT
+
+    monkeypatch.setattr(_openai, "OPENAI_REQUEST_TIMEOUT", 0.05)
+    monkeypatch.setattr(_openai, "OPENAI_ADMISSION_TIMEOUT", 0.05)
+    monkeypatch.setattr(_openai, "_use_shared_session", lambda: None)
+    monkeypatch.setattr(_scheduler, "OPENAI_QUOTA_STATE", tmp_path)
+    _scheduler.get_scheduler.cache_clear()
+
+    async def hanging_acreate(request_timeout, **_):
+        # As the openai library does once the request timeout passes.
+        await asyncio.sleep(request_timeout)
+        raise openai.error.Timeout("Request timed out")
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", hanging_acreate)
+
+    recorded = []
+    monkeypatch.setattr(_openai.circuit, "record", recorded.append)
+
+    run_once = _openai._run_completion.retry_with(
+        stop=stop_after_attempt(1), reraise=True
+    )
+
+    with pytest.raises(openai.error.Timeout):
+        asyncio.run(
+            run_once(
+                {
+                    "engine": GPT_TURBO_SMALL_CONTEXT,
+                    "prompt": "Hello",
+                    "max_tokens": 16,
+                },
+                _telemetry.Attempts(),
+            )
+        )
+
+    _scheduler.get_scheduler.cache_clear()
+
+    assert len(recorded) == 1
+    assert isinstance(recorded[0], openai.error.Timeout)
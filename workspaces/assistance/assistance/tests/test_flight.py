@@ -0,0 +1,73 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel, protected-access
+
+import asyncio
+import hashlib
+import subprocess
+import sys
+import time
+
+import pytest
+
+# Holds the lock on a key's byte from another process, as a worker computing
+# that key would.
+HOLD_LOCK = """
+import fcntl, os, sys, time
+file_descriptor = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT)
+fcntl.lockf(file_descriptor, fcntl.LOCK_EX, 1, int(sys.argv[2]))
+print("locked", flush=True)
+time.sleep(30)
+"""
+
+
+def test_waiting_on_another_process_stops_at_the_deadline(monkeypatch, tmp_path):
+    from assistance import _deadlines
+    from assistance._cache import flight
+
+    lock_path = tmp_path / "completion-cache.lock"
+    monkeypatch.setattr(flight, "COMPLETION_CACHE_LOCK", lock_path)
+    monkeypatch.setattr(flight, "_lock_file_descriptor", None)
+
+    key = "completion:test"
+    offset = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=7).digest())
+
+    with subprocess.Popen(
+        [sys.executable, "-c", HOLD_LOCK, str(lock_path), str(offset)],
+        stdout=subprocess.PIPE,
+        text=True,
+    ) as holder:
+        try:
+            assert holder.stdout is not None
+            assert holder.stdout.readline().strip() == "locked"
+
+            async def create():
+                raise AssertionError("Computed while another process held the key")
+
+            async def load():
+                return None
+
+            async def wait_within_budget():
+                with _deadlines.budget(0.3):
+                    await flight.run_once(key, create, load)
+
+            start = time.monotonic()
+
+            with pytest.raises(_deadlines.DeadlineExceeded):
+                asyncio.run(wait_within_budget())
+
+            assert time.monotonic() - start < 2
+        finally:
+            holder.kill()
@@ -0,0 +1,65 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel
+
+import pytest
+
+
+def test_valid_json_needs_no_repairs():
+    from assistance._json_repair import loads_with_repairs
+
+    assert loads_with_repairs('{"a": [1, 2]}') == ({"a": [1, 2]}, [])
+
+
+@pytest.mark.parametrize(
+    "text, repairs",
+    [
+        ('```json\n{"a": 1}\n```', ["code_fence"]),
+        ('Here is the JSON:\n{"a": 1}\nThanks!', ["surrounding_text"]),
+        ("{“a”: 1}", ["smart_quotes"]),
+        ('{"a": 1, "b": true,}', ["trailing_commas"]),
+        ("{'a': 1}", ["tolerant_parser"]),
+        ('{"a": "line\nbreak"}', ["tolerant_parser"]),
+    ],
+)
+def test_each_repair_is_recorded(text, repairs):
+    from assistance._json_repair import loads_with_repairs
+
+    data, applied = loads_with_repairs(text)
+
+    assert applied == repairs
+    assert data["a"] in (1, "line\nbreak")
+
+
+def test_repairs_completed_by_the_tolerant_parser_record_it():
+    from assistance._json_repair import loads_with_repairs
+
+    # The trailing comma is accepted by the Python literal fallback before
+    # the trailing comma repair is reached.
+    assert loads_with_repairs('```json\n{"a": 1,}\n```') == (
+        {"a": 1},
+        ["code_fence", "tolerant_parser"],
+    )
+
+
+def test_unrepairable_text_raises_the_original_error():
+    import json
+
+    from assistance._json_repair import loads_with_repairs
+
+    with pytest.raises(json.JSONDecodeError) as error:
+        loads_with_repairs("Sorry, I can't help with that.")
+
+    assert error.value.pos == 0
@@ -0,0 +1,60 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel
+
+
+RATE_LIMIT = {
+    "requests_per_minute": 600,
+    "tokens_per_minute": 6000,
+    "max_concurrency": 4,
+}
+
+
+def test_quota_is_shared_between_processes(tmp_path):
+    from assistance._scheduler import SharedQuota
+
+    # Each process opens the state file separately.
+    first = SharedQuota(tmp_path / "model", RATE_LIMIT)
+    second = SharedQuota(tmp_path / "model", RATE_LIMIT)
+
+    assert first.try_take(5000) == 0
+
+    # Only 1000 tokens remain for the other process, refilling at 100 a
+    # second.
+    wait = second.try_take(3000)
+    assert 19 < wait <= 20
+
+    assert second.try_take(500) == 0
+
+
+def test_requests_larger_than_the_bucket_wait_for_a_full_bucket(tmp_path):
+    from assistance._scheduler import SharedQuota
+
+    quota = SharedQuota(tmp_path / "model", RATE_LIMIT)
+
+    assert quota.try_take(8000) == 0
+    assert 59 < quota.try_take(8000) <= 60
+
+
+def test_rate_limiting_is_shared_between_processes(tmp_path):
+    from assistance._scheduler import RATE_LIMITED_BACK_OFF, SharedQuota
+
+    first = SharedQuota(tmp_path / "model", RATE_LIMIT)
+    second = SharedQuota(tmp_path / "model", RATE_LIMIT)
+
+    first.on_rate_limited()
+
+    assert second.get_rate_scale() == RATE_LIMITED_BACK_OFF
+    assert second.try_take(1) > 0
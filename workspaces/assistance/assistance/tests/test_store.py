@@ -0,0 +1,34 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel
+
+
+def test_only_legacy_keys_fall_through_to_the_directory_store(tmp_path):
+    from assistance._cache.store import DirectoryStore, SqliteStore
+
+    looked_up = []
+
+    class RecordingStore(DirectoryStore):
+        def get(self, key: str):
+            looked_up.append(key)
+            return super().get(key)
+
+    store = SqliteStore(
+        tmp_path / "cache.db", legacy=RecordingStore(tmp_path / "legacy")
+    )
+
+    assert store.get("completion:gpt-4-0613:v1:0123456789abcdef") is None
+    assert store.get("0123456789abcdef") is None
+    assert looked_up == ["0123456789abcdef"]
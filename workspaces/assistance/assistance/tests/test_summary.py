@@ -0,0 +1,64 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel
+
+import asyncio
+
+
+class _WordEncoding:
+    """Counts a token per word, so that the test needs no tiktoken
+    download."""
+
+    def encode(self, text: str, **_):
+        return text.split(" ")
+
+    def decode(self, tokens: list[str]):
+        return " ".join(tokens)
+
+
+def test_oversized_email_after_the_first_is_summarised(monkeypatch):
+    from assistance import _tokens
+    from assistance._completion import summary
+    from assistance._config import GPT_SOTA
+
+    monkeypatch.setattr(_tokens, "_get_encoding", lambda model: _WordEncoding())
+    _tokens._token_counts.clear()  # pylint: disable = protected-access
+
+    prompts = []
+
+    async def get_completion_only(**kwargs):
+        prompts.append(kwargs["prompt"])
+        return "A short summary."
+
+    monkeypatch.setattr(summary, "get_completion_only", get_completion_only)
+
+    email_thread = ["A short first email.", "word " * 7800, "Another email."]
+
+    response, transcript = asyncio.run(
+        summary.completion_on_thread_with_summary_fallback(
+            scope="test",
+            prompt="Respond to this thread:\n\n{transcript}",
+            email_thread=email_thread,
+            api_key="",
+            engine=GPT_SOTA,
+            max_tokens=512,
+        )
+    )
+
+    assert response == "A short summary."
+    assert transcript.endswith("Another email.")
+
+    # One summary call along with the final completion.
+    assert len(prompts) == 2
@@ -0,0 +1,34 @@
+# Copyright (C) 2023 Simon Biggs
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# pylint: disable = import-outside-toplevel
+
+
+def test_token_counts_are_approximated_without_the_encoding(monkeypatch):
+    import tiktoken
+
+    from assistance import _tokens
+
+    def unavailable(*_):
+        raise ConnectionError("No network")
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", unavailable)
+    monkeypatch.setattr(tiktoken, "get_encoding", unavailable)
+    monkeypatch.setattr(_tokens, "_get_encoding", _tokens._get_encoding.__wrapped__)
+    _tokens._token_counts.clear()  # pylint: disable = protected-access
+
+    text = "An offline test of the token count."
+
+    assert _tokens.count_tokens(text, "gpt-4-0613") == 12
+    assert _tokens.truncate_to_tokens(text, "gpt-4-0613", 2) == "An off"